@@ -1,13 +1,79 @@
-from dataclasses import dataclass
-from typing import List, Any, Callable, Dict, Tuple
+from dataclasses import dataclass, field
+from typing import List, Any, Callable, Dict, Tuple, Hashable, Optional, Set, Collection
 import random
+from atomic_file import atomic_write
 import numpy as np
 
 DiscreteVector = List[int]
+# A DiscreteVector of 0/1 alleles packed into uint64 words: allele i is bit (i % 64) of word (i // 64)
+PackedVector = np.ndarray
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(words: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(words: np.ndarray) -> np.ndarray:
+        as_bytes = np.ascontiguousarray(words).view(np.uint8)
+        return _POPCOUNT_TABLE[as_bytes].sum(axis=-1, dtype=np.int64)
+
+def pack_matrix(matrix) -> np.ndarray:
+    """
+    Pack a (rows x length) matrix of 0/1 alleles into a (rows x ceil(length/64)) matrix of uint64 words.
+    """
+    bits = np.asarray(matrix, dtype=np.uint8)
+    if bits.ndim == 1:
+        bits = bits.reshape(1, -1)
+    num_words = (bits.shape[1] + 63) // 64
+    packed = np.zeros((bits.shape[0], num_words * 8), dtype=np.uint8)
+    packed[:, :(bits.shape[1] + 7) // 8] = np.packbits(bits, axis=1, bitorder="little")
+    return packed.view("<u8")
+
+def pack_vector(vector: DiscreteVector) -> PackedVector:
+    """
+    Pack a single 0/1 vector into uint64 words.
+    """
+    return pack_matrix([vector])[0]
+
+def unpack_vector(vector: PackedVector, length: int) -> DiscreteVector:
+    """
+    Inverse of pack_vector(): return the first length alleles of the packed vector as a list.
+    """
+    as_bytes = np.ascontiguousarray(vector, dtype="<u8").view(np.uint8)
+    return np.unpackbits(as_bytes, count=length, bitorder="little").tolist()
+
+def unpack_matrix(matrix: np.ndarray, length: int) -> np.ndarray:
+    """
+    Inverse of pack_matrix(): return the (rows x length) uint8 matrix of alleles.
+    """
+    matrix = np.ascontiguousarray(matrix, dtype="<u8")
+    as_bytes = matrix.view(np.uint8).reshape(matrix.shape[0], matrix.shape[1]*8)
+    return np.unpackbits(as_bytes, axis=1, count=length, bitorder="little")
+
+def popcount_distance(vector1: PackedVector, vector2: PackedVector) -> int:
+    """
+    Hamming distance between two PackedVectors, via XOR and popcount over the words.
+    """
+    return int(_popcount(np.bitwise_xor(vector1, vector2)))
+
+def popcount_distances(matrix: np.ndarray, vector: PackedVector) -> np.ndarray:
+    """
+    Hamming distances between every row of a packed matrix and a single PackedVector.
+    """
+    return _popcount(np.bitwise_xor(matrix, vector))
+
+def vector_key(vector: DiscreteVector) -> Hashable:
+    """
+    A hashable key for the content of a DiscreteVector or PackedVector.
+    """
+    if isinstance(vector, np.ndarray):
+        return vector.tobytes()
+    return tuple(vector)
 
 @dataclass
 class BKTreeNode:
-    # The vector that is compared via the distance metric
+    # The vector that is compared via the distance metric (a DiscreteVector or a PackedVector)
     vector: DiscreteVector
     # The list of elements that are associated with the above vector
     elements: List[Any]
@@ -15,13 +81,52 @@ class BKTreeNode:
     id: int
     # The map from distance (e.g., D=1) to the child node associated with that distance
     children: Dict[int, "BKTreeNode"]
+    # The distinct elements of the node, kept up to date by add_elements() so that skip checks are set operations
+    element_set: Set[Any] = field(default_factory=set)
+
+    def __post_init__(self):
+        self.element_set.update(self.elements)
     
     @staticmethod
     def make_empty(vector=[]) -> "BKTreeNode":
         return BKTreeNode(vector=vector, elements=[], id = -1, children={})
 
     def is_empty(self) -> bool:
-        return not self.vector
+        return len(self.vector) == 0
+
+    def add_elements(self, elements: List[Any]):
+        self.elements.extend(elements)
+        self.element_set.update(elements)
+
+# Map from vector_key() of a vector to the (unique) BK tree node holding that vector
+ExactMatchIndex = Dict[Hashable, BKTreeNode]
+
+@dataclass
+class LookupStats:
+    """
+    Per-query traversal counters of BK tree lookups, for profiling how well the tree prunes. Pass one to a
+    lookup function to have it filled in.
+    """
+    # The nodes looked at for each query, including a node found by a probe of the exact-match index
+    nodes_visited: np.ndarray
+    # The distance computations for each query (an exact-match index hit needs none)
+    distance_evals: np.ndarray
+    # The subtrees that each query did not descend into because the triangle inequality ruled them out
+    pruned_subtrees: np.ndarray
+
+    @staticmethod
+    def zeros(num_queries: int) -> "LookupStats":
+        return LookupStats(nodes_visited=np.zeros(num_queries, dtype=np.int64),
+                           distance_evals=np.zeros(num_queries, dtype=np.int64),
+                           pruned_subtrees=np.zeros(num_queries, dtype=np.int64))
+
+    def __getitem__(self, queries: slice) -> "LookupStats":
+        """
+        The counters of a slice of the queries, as views that lookups of just those queries update in place
+        """
+        return LookupStats(nodes_visited=self.nodes_visited[queries],
+                           distance_evals=self.distance_evals[queries],
+                           pruned_subtrees=self.pruned_subtrees[queries])
 
 # This turned out to be not at all helpful -- just building the BKTree from a random start node is fine
 def find_best_start(vectors: List[DiscreteVector],
@@ -46,29 +151,50 @@ def find_best_start(vectors: List[DiscreteVector],
 def bk_tree_insert(root_node: BKTreeNode,
                    elements: List[Any],
                    vector: DiscreteVector,
-                   distance: Callable[[DiscreteVector, DiscreteVector], int]) -> BKTreeNode:
+                   distance: Callable[[DiscreteVector, DiscreteVector], int],
+                   index: Optional[ExactMatchIndex] = None) -> BKTreeNode:
     """
     Insert the element into the BK tree rooted at root_node.
 
     :param root_node: The root of the BK tree.
     :param element: The element (ID, object containing data, whatever...) to be inserted.
     :param vector: The DiscreteVector associated with the element.
-    :param distance: The distance callback for the DiscreteVector (e.g., hamming distance implementation).
+    :param distance: The distance callback for the DiscreteVector (e.g., hamming distance implementation, or
+        popcount_distance for PackedVectors).
+    :param index: Optional exact-match index for the tree. Vectors already in the index are merged into their
+        node without walking the tree, so only unique vectors are inserted. If used, it must be passed to every
+        insert into this tree. New nodes get their position in the index as their id.
     :returns: The node which contains element after insertion.
     """
+    if index is None:
+        return _insert_into_tree(root_node, elements, vector, distance)
+    key = vector_key(vector)
+    node = index.get(key)
+    if node is not None:
+        node.add_elements(elements)
+        return node
+    node = _insert_into_tree(root_node, elements, vector, distance)
+    node.id = len(index)
+    index[key] = node
+    return node
+
+def _insert_into_tree(root_node: BKTreeNode,
+                      elements: List[Any],
+                      vector: DiscreteVector,
+                      distance: Callable[[DiscreteVector, DiscreteVector], int]) -> BKTreeNode:
     if root_node.is_empty():
         root_node.vector = vector
-        root_node.elements.extend(elements)
+        root_node.add_elements(elements)
         return root_node
     cur_node = root_node
     while cur_node is not None:
         k = distance(cur_node.vector, vector)
         if k == 0:
-            cur_node.elements.extend(elements)
+            cur_node.add_elements(elements)
             return cur_node
         new_node = cur_node.children.get(k)
         if new_node is None:
-            new_node = BKTreeNode(vector=vector, elements=list(elements), children={})
+            new_node = BKTreeNode(vector=vector, elements=list(elements), id=-1, children={})
             cur_node.children[k] = new_node
             return new_node
         cur_node = new_node
@@ -83,24 +209,25 @@ def bk_tree_insert2(root_node: BKTreeNode,
     :param root_node: The root of the BK tree.
     :param element: The element (ID, object containing data, whatever...) to be inserted.
     :param vector: The DiscreteVector associated with the element.
-    :param distance: The distance callback for the DiscreteVector (e.g., hamming distance implementation).
+    :param distance: The distance callback for the DiscreteVector (e.g., hamming distance implementation, or
+        popcount_distance for PackedVectors).
     :returns: The node which contains element after insertion.
     """
     best_dist = 2**32
     if root_node.is_empty():
         root_node.vector = vector
-        root_node.elements.extend(elements)
+        root_node.add_elements(elements)
         return best_dist
     cur_node = root_node
     while cur_node is not None:
         k = distance(cur_node.vector, vector)
         best_dist = min(best_dist,k)
         if k == 0:
-            cur_node.elements.extend(elements)
+            cur_node.add_elements(elements)
             return best_dist
         new_node = cur_node.children.get(k)
         if new_node is None:
-            new_node = BKTreeNode(vector=vector, elements=list(elements), children={})
+            new_node = BKTreeNode(vector=vector, elements=list(elements), id=-1, children={})
             cur_node.children[k] = new_node
             return best_dist
         cur_node = new_node
@@ -109,42 +236,49 @@ def bk_tree_insert2(root_node: BKTreeNode,
 def bk_tree_lookup(root_node: BKTreeNode,
                    vector: DiscreteVector,
                    distance: Callable[[DiscreteVector, DiscreteVector], int],
-                   skip: List[Any]) -> Tuple[List[BKTreeNode], int]:
+                   skip: Collection[Any],
+                   index: Optional[ExactMatchIndex] = None,
+                   stats: Optional[LookupStats] = None) -> Tuple[List[BKTreeNode], int, List[BKTreeNode]]:
     """
-    Lookup the nearest neighbor(s) to the given vector and return their nodes and the best distance
+    Lookup the nearest neighbor(s) to the given vector and return their nodes, the best distance and the
+    exact (distance 0) matches
 
     :param root_node: The root of the BK-tree.
     :param vector: The query DiscreteVector.
-    :param skip: If a node only has the elements in this list then we skip this node
-    :param collect_all: If True, find the distance of the nearest neighbor and then return all
-        nodes that have that distance from the query vector. If False, just return the first one
-        encountered.
+    :param skip: If a node only has the elements in this collection then we skip this node. Use a set (e.g.,
+        of integer sample IDs) so that the check does not rescan the node's elements.
+    :param index: Optional exact-match index built by bk_tree_insert(). If given, an exact match is found by
+        a single hash probe instead of a tree traversal.
+    :param stats: Optional LookupStats for a single query, whose counters are incremented.
+    :returns: The tuple (results, dist_best, exact_matches). When there is an exact match, results and
+        exact_matches both hold just its node, otherwise exact_matches is empty.
     """
     if root_node.is_empty():
-        return set()
+        return [], 2**32, []
+    if index is not None:
+        node = index.get(vector_key(vector))
+        if node is not None and not _has_only_skipped(node, skip):
+            if stats is not None:
+                stats.nodes_visited[0] += 1
+            return [node], 0, [node]
     node_list = [root_node]
     results = []
     dist_best = 2**32
     while node_list:
         node = node_list.pop()
         dist = distance(node.vector, vector)
-
-        # Check to see if the node contains only elements we want to skip (contains only close relatives)
-        has_only_relatives = True
-        for element_to_check in node.elements:
-            if not element_to_check in skip:
-                has_only_relatives = False
-                break
+        if stats is not None:
+            stats.nodes_visited[0] += 1
+            stats.distance_evals[0] += 1
 
         # We do not return nodes that have no elements or if the node only contains elements we want to skip
-        ignore_this_node = (len(node.elements) == 0) or (has_only_relatives)
+        ignore_this_node = _has_only_skipped(node, skip)
             
         # We return if we find an exact match (that isn't something we want to skip)
         if (dist == 0) and (not ignore_this_node):
             results = [node]
             dist_best = 0
-            return results, dist_best
-            #print(exact_matches)
+            return results, dist_best, results
         
         if not ignore_this_node:
             if dist < dist_best:
@@ -158,4 +292,327 @@ def bk_tree_lookup(root_node: BKTreeNode,
             bound = abs(next_dist - dist)
             if (bound <= dist_best):
                 node_list.append(next_node)
-    return results, dist_best
\ No newline at end of file
+            elif stats is not None:
+                stats.pruned_subtrees[0] += 1
+    return results, dist_best, []
+
+def bk_tree_lookup_batch(root_node: BKTreeNode,
+                         vectors: np.ndarray,
+                         skips: List[Collection[Any]],
+                         index: Optional[ExactMatchIndex] = None,
+                         stats: Optional[LookupStats] = None,
+                         bounds: Optional[np.ndarray] = None,
+                         max_distance: Optional[int] = None,
+                         max_visits: Optional[int] = None
+                         ) -> Tuple[List[Tuple[List[BKTreeNode], int, List[BKTreeNode]]], np.ndarray]:
+    """
+    Lookup the nearest neighbor(s) of many query vectors in a single traversal of a BK-tree of PackedVectors.
+
+    Every query sees the same nodes in the same order as it would in bk_tree_lookup(), and keeps its own
+    pruning bound, so the results are identical. A node is visited once for all the queries that have not
+    pruned it, and its distance to all of them is computed in one vectorized XOR+popcount.
+
+    :param root_node: The root of the BK-tree.
+    :param vectors: The (num_queries x words) matrix of packed query vectors.
+    :param skips: For each query, the elements to skip (see bk_tree_lookup()).
+    :param index: Optional exact-match index built by bk_tree_insert().
+    :param stats: Optional LookupStats for all the queries, whose counters are incremented.
+    :param bounds: Optional upper bounds on the nearest distance of each query, each the distance to a vector in
+        the tree whose elements are not all skipped (e.g. a neighbour found in the previous window). The traversal
+        starts with them as its pruning bounds, which gives the same results with fewer distance evaluations.
+    :param max_distance: Optional cutoff: only neighbours within this distance are returned, and a query without
+        one gets no results (and dist_best 2**32). The cutoff is the initial pruning bound of every query, so a
+        small one prunes most of the tree.
+    :param max_visits: Optional budget of nodes visited per query. A query that needs more stops with the best
+        neighbours found so far, which may not be the nearest.
+    :returns: For each query, the tuple (results, dist_best, exact_matches) from bk_tree_lookup(), and the boolean
+        array of the queries whose results are exact: False for those cut short by max_visits.
+    """
+    num_queries = len(vectors)
+    results = [[] for _ in range(num_queries)]
+    exact_matches = [[] for _ in range(num_queries)]
+    dist_best = np.full(num_queries, 2**32, dtype=np.int64)
+    if bounds is not None:
+        dist_best = np.minimum(dist_best, bounds)
+    if max_distance is not None:
+        dist_best = np.minimum(dist_best, max_distance)
+    done = np.zeros(num_queries, dtype=bool)
+    if root_node.is_empty():
+        return _batch_results(results, dist_best, exact_matches), np.ones(num_queries, dtype=bool)
+    if index is not None:
+        for q in range(num_queries):
+            node = index.get(vector_key(vectors[q]))
+            if node is not None and not _has_only_skipped(node, skips[q]):
+                results[q] = exact_matches[q] = [node]
+                dist_best[q] = 0
+                done[q] = True
+        if stats is not None:
+            stats.nodes_visited[done] += 1
+
+    complete = _traverse_batch(root_node, vectors, skips, results, exact_matches, dist_best, done,
+                               lambda node: node.vector,
+                               lambda node: node.children.items(),
+                               _has_only_skipped, stats, max_visits)
+    return _batch_results(results, dist_best, exact_matches), complete
+
+def _batch_results(results, dist_best, exact_matches):
+    """
+    The (results, dist_best, exact_matches) of every query of a batched lookup; a query without results (e.g.
+    none within the cutoff) gets dist_best 2**32
+    """
+    return [(results[q], int(dist_best[q]) if results[q] else 2**32, exact_matches[q]) for q in range(len(results))]
+
+def _traverse_batch(root_node, vectors, skips, results, exact_matches, dist_best, done,
+                    vector_of, children_of, has_only_skipped, stats=None, max_visits=None):
+    """
+    The batched BK-tree traversal shared by the pointer-based and the flat BK trees. Updates results,
+    exact_matches, dist_best and done (one entry per query) in place, and the counters of stats if it is given;
+    the callbacks give a node's vector, its (distance, child) pairs, and whether it only holds skipped elements.
+    With max_visits, a query stops when it would visit more nodes. Returns which queries were not stopped
+    """
+    visits = np.zeros(len(vectors), dtype=np.int64)
+    complete = np.ones(len(vectors), dtype=bool)
+    node_list = [(root_node, np.flatnonzero(~done))]
+    while node_list:
+        node, active = node_list.pop()
+        active = active[~done[active]]
+        if max_visits is not None:
+            spent = visits[active] >= max_visits
+            if spent.any():
+                done[active[spent]] = True
+                complete[active[spent]] = False
+                active = active[~spent]
+        if len(active) == 0:
+            continue
+        visits[active] += 1
+        dists = popcount_distances(vectors[active], vector_of(node))
+        if stats is not None:
+            stats.nodes_visited[active] += 1
+            stats.distance_evals[active] += 1
+
+        for i in np.flatnonzero(dists <= dist_best[active]):
+            q = active[i]
+            dist = dists[i]
+            if has_only_skipped(node, skips[q]):
+                continue
+            if dist == 0:
+                # An exact match ends the search for this query
+                results[q] = exact_matches[q] = [node]
+                dist_best[q] = 0
+                done[q] = True
+            elif dist < dist_best[q]:
+                results[q] = [node]
+                dist_best[q] = dist
+            else:
+                results[q].append(node)
+
+        live = ~done[active]
+        active = active[live]
+        dists = dists[live]
+        bounds = dist_best[active]
+        for next_dist, next_node in children_of(node):
+            # Each query descends into next_node only if its own bound allows it
+            descend = np.abs(next_dist - dists) <= bounds
+            if descend.any():
+                node_list.append((next_node, active[descend]))
+            if stats is not None:
+                stats.pruned_subtrees[active[~descend]] += 1
+    return complete
+
+def _has_only_skipped(node: BKTreeNode, skip: Collection[Any]) -> bool:
+    """
+    True if the node has no elements, or contains only elements we want to skip (close relatives)
+    """
+    if isinstance(skip, (set, frozenset)):
+        # Fails immediately on the size check when the node has more distinct elements than there are relatives
+        return node.element_set <= skip
+    for element_to_check in node.element_set:
+        if not element_to_check in skip:
+            return False
+    return True
+
+@dataclass
+class FlatBKTree:
+    """
+    A BK tree stored in a handful of flat arrays instead of one Python object per node, so that it can be
+    saved to a file and memory-mapped back in (see flatten_bk_tree(), save_flat_bk_tree() and
+    load_flat_bk_tree()). Nodes are numbered 0...num_nodes-1, with the root as node 0.
+    """
+    # (num_nodes x words) matrix with the PackedVector of every node
+    vectors: np.ndarray
+    # The children of node i are child_nodes[child_offsets[i]:child_offsets[i+1]], at the distances in
+    # child_dists over the same range (in the order they were inserted)
+    child_offsets: np.ndarray
+    child_dists: np.ndarray
+    child_nodes: np.ndarray
+    # The elements of node i are elements[element_offsets[i]:element_offsets[i+1]] (integer sample IDs)
+    element_offsets: np.ndarray
+    elements: np.ndarray
+    # The number of distinct elements of each node
+    num_distinct: np.ndarray
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.vectors)
+
+    def is_empty(self) -> bool:
+        return self.num_nodes == 0
+
+    def node_elements(self, node: int) -> np.ndarray:
+        return self.elements[self.element_offsets[node]:self.element_offsets[node+1]]
+
+    def node_children(self, node: int):
+        start, end = self.child_offsets[node], self.child_offsets[node+1]
+        return zip(self.child_dists[start:end].tolist(), self.child_nodes[start:end].tolist())
+
+_FLAT_BK_TREE_MAGIC = b"BKTREE01"
+_FLAT_BK_TREE_ARRAYS = ["vectors", "child_offsets", "child_dists", "child_nodes", "element_offsets", "elements",
+                        "num_distinct"]
+
+def flatten_bk_tree(root_node: BKTreeNode) -> FlatBKTree:
+    """
+    Convert a BK tree of PackedVectors with integer elements into a FlatBKTree. If the tree was built with an
+    exact-match index then each node keeps its id as its flat node number, otherwise nodes are numbered in
+    depth-first order.
+    """
+    nodes = []
+    node_list = [] if root_node.is_empty() else [root_node]
+    while node_list:
+        node = node_list.pop()
+        nodes.append(node)
+        node_list.extend(reversed(list(node.children.values())))
+    if sorted(node.id for node in nodes) == list(range(len(nodes))):
+        nodes.sort(key=lambda node: node.id)
+    number = {id(node): i for i, node in enumerate(nodes)}
+
+    num_words = len(root_node.vector)
+    vectors = np.zeros((len(nodes), num_words), dtype="<u8")
+    child_offsets = np.zeros(len(nodes)+1, dtype="<i8")
+    element_offsets = np.zeros(len(nodes)+1, dtype="<i8")
+    child_dists, child_nodes, elements, num_distinct = [], [], [], []
+    for i, node in enumerate(nodes):
+        vectors[i] = node.vector
+        child_dists.extend(node.children.keys())
+        child_nodes.extend(number[id(child)] for child in node.children.values())
+        child_offsets[i+1] = len(child_nodes)
+        elements.extend(node.elements)
+        element_offsets[i+1] = len(elements)
+        num_distinct.append(len(node.element_set))
+    return FlatBKTree(vectors=vectors,
+                      child_offsets=child_offsets,
+                      child_dists=np.array(child_dists, dtype="<i8"),
+                      child_nodes=np.array(child_nodes, dtype="<i8"),
+                      element_offsets=element_offsets,
+                      elements=np.array(elements, dtype="<i8"),
+                      num_distinct=np.array(num_distinct, dtype="<i8"))
+
+def save_flat_bk_tree(tree: FlatBKTree, filename: str):
+    """
+    Write a FlatBKTree to a file: an 8-byte magic, the array sizes, then each array's raw little-endian
+    8-byte values. The file is written under a temporary name and then renamed, so that a reader never sees a
+    partial tree.
+    """
+    sizes = [tree.num_nodes, tree.vectors.shape[1], len(tree.child_nodes), len(tree.elements)]
+    with atomic_write(filename) as temp_filename, open(temp_filename, "wb") as f:
+        f.write(_FLAT_BK_TREE_MAGIC)
+        f.write(np.array(sizes, dtype="<u8").tobytes())
+        for name in _FLAT_BK_TREE_ARRAYS:
+            f.write(np.ascontiguousarray(getattr(tree, name)).tobytes())
+
+def load_flat_bk_tree(filename: str, mmap: bool = True) -> FlatBKTree:
+    """
+    Load a FlatBKTree written by save_flat_bk_tree(). With mmap=True the arrays are read-only memory maps of
+    the file, so loading is immediate and the pages are shared between all processes using the same file.
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(_FLAT_BK_TREE_MAGIC)) != _FLAT_BK_TREE_MAGIC:
+            raise ValueError(f"{filename} is not a flat BK tree file")
+        num_nodes, num_words, num_children, num_elements = np.frombuffer(f.read(32), dtype="<u8").tolist()
+    shapes = {"vectors": (num_nodes, num_words), "child_offsets": (num_nodes+1,), "child_dists": (num_children,),
+              "child_nodes": (num_children,), "element_offsets": (num_nodes+1,), "elements": (num_elements,),
+              "num_distinct": (num_nodes,)}
+    offset = len(_FLAT_BK_TREE_MAGIC) + 32
+    arrays = {}
+    for name in _FLAT_BK_TREE_ARRAYS:
+        dtype = "<u8" if name == "vectors" else "<i8"
+        count = int(np.prod(shapes[name]))
+        if mmap and count > 0:
+            arrays[name] = np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shapes[name])
+        else:
+            arrays[name] = np.fromfile(filename, dtype=dtype, count=count, offset=offset).reshape(shapes[name])
+        offset += count * 8
+    return FlatBKTree(**arrays)
+
+def flat_bk_tree_depth(tree: FlatBKTree) -> int:
+    """
+    The number of levels below the root of a FlatBKTree (0 for an empty or single-node tree)
+    """
+    depth = 0
+    level = np.zeros(0 if tree.is_empty() else 1, dtype=np.int64)
+    while len(level) > 0:
+        level = np.concatenate([tree.child_nodes[start:end] for start, end in
+                                zip(tree.child_offsets[level].tolist(), tree.child_offsets[level+1].tolist())])
+        if len(level) > 0:
+            depth += 1
+    return depth
+
+def flat_exact_index(tree: FlatBKTree) -> Dict[Hashable, int]:
+    """
+    The exact-match index of a FlatBKTree: map from vector_key() of each node's vector to its node number
+    """
+    return {vector.tobytes(): i for i, vector in enumerate(np.ascontiguousarray(tree.vectors))}
+
+def flat_bk_tree_lookup_batch(tree: FlatBKTree,
+                              vectors: np.ndarray,
+                              skips: List[Collection[Any]],
+                              index: Optional[Dict[Hashable, int]] = None,
+                              stats: Optional[LookupStats] = None,
+                              bounds: Optional[np.ndarray] = None,
+                              max_distance: Optional[int] = None,
+                              max_visits: Optional[int] = None
+                              ) -> Tuple[List[Tuple[List[int], int, List[int]]], np.ndarray]:
+    """
+    The FlatBKTree version of bk_tree_lookup_batch(). Results are node numbers rather than BKTreeNodes.
+
+    :param tree: The flat BK tree.
+    :param vectors: The (num_queries x words) matrix of packed query vectors.
+    :param skips: For each query, the elements to skip (see bk_tree_lookup()).
+    :param index: Optional exact-match index from flat_exact_index().
+    :param stats: Optional LookupStats for all the queries, whose counters are incremented.
+    :param bounds: Optional upper bounds on the nearest distances (see bk_tree_lookup_batch()).
+    :param max_distance: Optional distance cutoff (see bk_tree_lookup_batch()).
+    :param max_visits: Optional budget of nodes visited per query (see bk_tree_lookup_batch()).
+    :returns: For each query, the tuple (results, dist_best, exact_matches), and which queries' results are exact
+        (see bk_tree_lookup_batch()).
+    """
+    def has_only_skipped(node, skip):
+        if tree.num_distinct[node] > len(skip):
+            return False
+        return all(element in skip for element in tree.node_elements(node).tolist())
+
+    num_queries = len(vectors)
+    results = [[] for _ in range(num_queries)]
+    exact_matches = [[] for _ in range(num_queries)]
+    dist_best = np.full(num_queries, 2**32, dtype=np.int64)
+    if bounds is not None:
+        dist_best = np.minimum(dist_best, bounds)
+    if max_distance is not None:
+        dist_best = np.minimum(dist_best, max_distance)
+    done = np.zeros(num_queries, dtype=bool)
+    if tree.is_empty():
+        return _batch_results(results, dist_best, exact_matches), np.ones(num_queries, dtype=bool)
+    if index is not None:
+        for q in range(num_queries):
+            node = index.get(vector_key(vectors[q]))
+            if node is not None and not has_only_skipped(node, skips[q]):
+                results[q] = exact_matches[q] = [node]
+                dist_best[q] = 0
+                done[q] = True
+        if stats is not None:
+            stats.nodes_visited[done] += 1
+
+    complete = _traverse_batch(0, vectors, skips, results, exact_matches, dist_best, done,
+                               lambda node: tree.vectors[node],
+                               tree.node_children,
+                               has_only_skipped, stats, max_visits)
+    return _batch_results(results, dist_best, exact_matches), complete
@@ -1,11 +1,172 @@
-from pyigd import IGDReader, IGDTransformer
+from pyigd import IGDReader, IGDTransformer, IGDWriter
 import argparse
+import multiprocessing
 import random
+from functools import partial
 import numpy as np
 from tqdm import tqdm
-import sys
+from edits import EditsWriter, EDITS_DTYPE, edit_records
+from noise_chunks import chunk_rng, imap_bounded
 
-if __name__ == "__main__":
+def flip_mask(samples, num_samples, zero_to_one, one_to_zero, rng):
+    """
+    Decide the flips of one variant by rolling a die for every sample at once: a 1 flips to 0 if its roll is
+    <= one_to_zero, and a 0 flips to 1 if its roll is <= zero_to_one.
+
+    :returns: The tuple (flipped_ones, flipped_zeros) of sorted sample index arrays.
+    """
+    is_one = np.zeros(num_samples, dtype=bool)
+    is_one[samples] = True
+    rolled_dice = rng.uniform(0, 1, size=num_samples)
+    flipped_ones = np.flatnonzero(is_one & (rolled_dice <= one_to_zero))
+    flipped_zeros = np.flatnonzero(~is_one & (rolled_dice <= zero_to_one))
+    return flipped_ones, flipped_zeros
+
+def flip_binomial(samples, num_samples, zero_to_one, one_to_zero, rng):
+    """
+    Decide the flips of one variant with the same distribution as flip_mask(), but by drawing the number of flips
+    of each kind from a binomial and then choosing that many samples. This never materializes a per-sample array,
+    so it is much faster when the rates are very low.
+
+    :returns: The tuple (flipped_ones, flipped_zeros) of sorted sample index arrays.
+    """
+    num_zeros = num_samples - len(samples)
+    flipped_ones = np.sort(rng.choice(samples, size=rng.binomial(len(samples), one_to_zero), replace=False))
+    # Choose ranks among the zeros, then map the rank r to the index of the r-th zero: that is r plus the number of
+    # ones whose count of preceding zeros (samples[j] - j) is <= r
+    ranks = np.sort(rng.choice(num_zeros, size=rng.binomial(num_zeros, zero_to_one), replace=False))
+    flipped_zeros = ranks + np.searchsorted(samples - np.arange(len(samples)), ranks, side="right")
+    return flipped_ones, flipped_zeros
+
+FLIP_METHODS = {"mask": flip_mask, "binomial": flip_binomial}
+
+def add_noise(samples, num_samples, zero_to_one, one_to_zero, rng, method="mask"):
+    """
+    Flip the alleles of one variant.
+
+    :param samples: The sorted sample indexes that have the alternate allele.
+    :returns: The tuple (new_samples, flipped, original_alleles) where new_samples is the sorted list of sample
+        indexes with the alternate allele after flipping, and flipped/original_alleles are the flipped sample
+        indexes (sorted) and their alleles before flipping.
+    """
+    samples = np.asarray(samples, dtype=np.int64)
+    flipped_ones, flipped_zeros = FLIP_METHODS[method](samples, num_samples, zero_to_one, one_to_zero, rng)
+    new_samples = np.union1d(np.setdiff1d(samples, flipped_ones, assume_unique=True), flipped_zeros)
+    flipped = np.concatenate([flipped_ones, flipped_zeros])
+    original_alleles = np.concatenate([np.ones(len(flipped_ones), dtype=np.uint8),
+                                       np.zeros(len(flipped_zeros), dtype=np.uint8)])
+    order = np.argsort(flipped, kind="stable")
+    return new_samples.tolist(), flipped[order], original_alleles[order]
+
+# The precise way to add noise, to ensure that the rates are exactly as specified
+class AddNoiseToBV(IGDTransformer):
+    """
+    Adds noise to every variant, and records every flipped allele in an EditsWriter. Rows of missing data are
+    copied unchanged. Each chunk of chunk_size variants draws from its own chunk_rng(), so the result is the same
+    as that of add_noise_parallel() for the same entropy and chunk_size.
+    """
+    def __init__(self, in_stream, out_stream, edits, zero_to_one, one_to_zero, entropy, method="mask",
+                 chunk_size=10000, progress_bar=None):
+        super().__init__(in_stream, out_stream, use_bitvectors=False)
+        self.edits = edits
+        self.zero_to_one = zero_to_one
+        self.one_to_zero = one_to_zero
+        self.entropy = entropy
+        self.method = method
+        self.chunk_size = chunk_size
+        self.progress_bar = progress_bar
+        self.variant_index = 0
+        self.rng = None
+
+    def modify_samples(self, position, is_missing, samples, num_copies=0):
+        if self.progress_bar is not None:
+            self.progress_bar.update()
+        variant_index = self.variant_index
+        self.variant_index += 1
+        if variant_index % self.chunk_size == 0:
+            self.rng = chunk_rng(self.entropy, variant_index // self.chunk_size)
+        if is_missing:
+            return samples
+        new_samples, flipped, original_alleles = add_noise(samples, self.reader.num_samples, self.zero_to_one,
+                                                           self.one_to_zero, self.rng, self.method)
+        self.edits.add(variant_index, position, flipped, original_alleles)
+        return new_samples
+
+def noise_chunk(infile, chunk_size, entropy, zero_to_one, one_to_zero, method, chunk):
+    """
+    Add noise to the variants of one chunk of the input IGD file, as AddNoiseToBV does.
+
+    :returns: The tuple (variants, records) where variants is the list of (position, is_missing, samples,
+        num_copies) of every variant in the chunk, and records are the EDITS_DTYPE records of its flipped alleles.
+    """
+    rng = chunk_rng(entropy, chunk)
+    variants = []
+    records = []
+    with open(infile, "rb") as f:
+        reader = IGDReader(f)
+        for i in range(chunk * chunk_size, min((chunk + 1) * chunk_size, reader.num_variants)):
+            _, _, num_copies = reader.get_position_flags_copies(i)
+            position, is_missing, samples = reader.get_samples(i)
+            if not is_missing:
+                samples, flipped, original_alleles = add_noise(samples, reader.num_samples, zero_to_one,
+                                                               one_to_zero, rng, method)
+                records.append(edit_records(i, position, flipped, original_alleles))
+            variants.append((position, is_missing, samples, num_copies))
+    return variants, np.concatenate(records) if records else np.empty(0, dtype=EDITS_DTYPE)
+
+def add_noise_parallel(infile, outfile, edits, zero_to_one, one_to_zero, entropy, method="mask", chunk_size=10000,
+                       workers=1, progress_bar=None):
+    """
+    Add noise to every variant like AddNoiseToBV, but with the chunks processed by a pool of worker processes.
+    The main process writes the noisy chunks and their edits in order, so the output and edits file are the same
+    for any number of workers.
+    """
+    with open(infile, "rb") as fin, open(outfile, "wb") as fout:
+        reader = IGDReader(fin)
+        writer = IGDWriter(fout, reader.num_individuals, reader.ploidy, reader.is_phased, reader.source,
+                           reader.description)
+        writer.write_header()
+        num_chunks = (reader.num_variants + chunk_size - 1) // chunk_size
+        add_chunk_noise = partial(noise_chunk, infile, chunk_size, entropy, zero_to_one, one_to_zero, method)
+        with multiprocessing.Pool(workers) as pool:
+            chunks = imap_bounded(pool, add_chunk_noise, range(num_chunks), 4 * workers)
+            for chunk, (variants, records) in enumerate(chunks):
+                for i, (position, is_missing, samples, num_copies) in enumerate(variants, chunk * chunk_size):
+                    writer.write_variant(position, reader.get_ref_allele(i), reader.get_alt_allele(i), samples,
+                                         is_missing, num_copies)
+                if len(records) > 0:
+                    edits.add_records(records)
+                if progress_bar is not None:
+                    progress_bar.update(len(variants))
+        writer.write_index()
+        writer.write_variant_info()
+        writer.write_individual_ids(reader.get_individual_ids())
+        writer.write_variant_ids(reader.get_variant_ids())
+        writer.out.seek(0)
+        writer.write_header()
+
+# The approximate way to add noise, much faster but the rates may vary a little more!
+class AddNoiseApprox(IGDTransformer):
+    def __init__(self, in_stream, out_stream, zero_to_one, one_to_zero, progress_bar=None):
+        super().__init__(in_stream, out_stream, use_bitvectors=False)
+        self.zero_to_one = zero_to_one
+        self.one_to_zero = one_to_zero
+        self.progress_bar = progress_bar
+
+    def modify_samples(self, position, is_missing, samples, num_copies=0):
+        if self.progress_bar is not None:
+            self.progress_bar.update()
+        total_samples = self.reader.num_samples
+        ones = len(samples)
+        zeros = total_samples - ones
+        flip01 = int(zeros * self.zero_to_one)
+        flip10 = int(ones * self.one_to_zero)
+        random.shuffle(samples)
+        del samples[ones - flip10:]  # Flip 1's to 0's
+        samples.extend(np.random.randint(0, total_samples-1, flip01))
+        return sorted(set(samples))
+
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("infile", help="The input IGD file")
     parser.add_argument("outfile", help="The output IGD file")
@@ -13,6 +174,17 @@ if __name__ == "__main__":
         help="The probability of flipping a 0 to a 1")
     parser.add_argument("-n", "--one-to-zero", type=float, default=0.01,
         help="The probability of flipping a 1 to a 0")
+    parser.add_argument("-e", "--edits", default="edits.bin",
+        help="The binary edits file to write, with one record per flipped allele (see edits.py)")
+    parser.add_argument("-m", "--method", choices=sorted(FLIP_METHODS), default="mask",
+        help="How to choose the flips: a uniform roll per sample (mask), or binomial flip counts and a random choice "
+             "of samples (binomial, faster for very low rates)")
+    parser.add_argument("--seed", type=int, default=None,
+        help="Seed for the random number generators; the same seed gives the same output for any number of workers")
+    parser.add_argument("-j", "--workers", type=int, default=1,
+        help="Number of worker processes adding noise to chunks of variants")
+    parser.add_argument("-c", "--chunk_size", type=int, default=10000,
+        help="Number of variants per chunk; every chunk draws from its own random stream spawned from the seed")
     # parser.add_argument("--precise", action="store_true",
     #     help="Use the slower, more precise method of adding noise.")
     args = parser.parse_args()
@@ -20,44 +192,22 @@ if __name__ == "__main__":
     with open(args.infile, "rb") as f:
         r = IGDReader(f)
         total_variants = r.num_variants
-        total_samples = r.num_samples
     progress_bar = tqdm(total=total_variants)
+    entropy = np.random.SeedSequence(args.seed).entropy
 
-    # The precise way to add noise, to ensure that the rates are exactly as specified
-    class AddNoiseToBV(IGDTransformer):
-        def modify_samples(self, position, is_missing, samples):
-            with open("edits.csv",'a') as edits:
-                global progress_bar 
-                progress_bar.update()
-                num_samples = len(samples)
-                rolled_dice = np.random.uniform(0, 1, size=num_samples)
-                for i in range(num_samples):
-                    if samples[i] == 1 and rolled_dice[i] <= args.one_to_zero:
-                        samples[i] = 0
-                        edits.write(f"{position},i,1")
-                    elif samples[i] == 0 and rolled_dice[i] <= args.zero_to_one:
-                        samples[i] = 1
-                        edits.write(f"{position},i,0")
-            return samples
+    if args.workers > 1:
+        with EditsWriter(args.edits) as edits:
+            add_noise_parallel(args.infile, args.outfile, edits, args.zero_to_one, args.one_to_zero, entropy,
+                               args.method, args.chunk_size, args.workers, progress_bar)
+        return
 
-    # The approximate way to add noise, much faster but the rates may vary a little more!
-    class AddNoiseApprox(IGDTransformer):
-        def modify_samples(self, position, is_missing, samples):
-            global progress_bar 
-            progress_bar.update()
-            ones = len(samples)
-            zeros = total_samples - ones
-            flip01 = int(zeros * args.zero_to_one)
-            flip10 = int(ones * args.one_to_zero)
-            random.shuffle(samples)
-            del samples[ones - flip10:]  # Flip 1's to 0's
-            samples.extend(np.random.randint(0, total_samples-1, flip01))
-            return sorted(set(samples))
-
-
-    with open(sys.argv[1], "rb") as fin, open(sys.argv[2], "wb") as fout:
+    with open(args.infile, "rb") as fin, open(args.outfile, "wb") as fout, EditsWriter(args.edits) as edits:
         #if args.precise:
-        xformer = AddNoiseToBV(fin, fout, use_bitvectors=True)
+        xformer = AddNoiseToBV(fin, fout, edits, args.zero_to_one, args.one_to_zero, entropy, args.method,
+                               args.chunk_size, progress_bar)
         #else:
-        #    xformer = AddNoiseApprox(fin, fout, use_bitvectors=False)
-        xformer.transform()
\ No newline at end of file
+        #    xformer = AddNoiseApprox(fin, fout, args.zero_to_one, args.one_to_zero, progress_bar)
+        xformer.transform()
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,198 @@
-# adds errors to the vcf file. 0 to 1 flip rate is 0.000379 and 1 to 0 flip rate is 0.063983
+# adds errors to the vcf file (plain, gzip or BGZF). 0 to 1 flip rate is 0.000379 and 1 to 0 flip rate is 0.063983
 # return csv file with three rows: pos, hap, allele
 # hap uses a 0 based system. hap 0 and hap 1= individual 1
 # allele column is used to represent the original (non-error version) of an allele we flipped
 
 import numpy as np
-import sys
 import pandas as pd
+import argparse
+import contextlib
+import gzip
+import multiprocessing
+import os
+import struct
+import zlib
+from functools import partial
+from itertools import islice
+from noise_chunks import chunk_rng, imap_bounded
 
-def flip(allele):
-    if allele == 0:
-        if np.random.uniform(0, 1) <= 0.000379: #this is per site rate
-            return(True)
-        else:
-            return(False)
-    else:
-        if np.random.uniform(0, 1) <= 0.063983: 
-            return(True)
-        else:
-            return(False)
+def flip_alleles(alleles, zero_to_one, one_to_zero, rng):
+    """
+    Roll a die per haplotype allele (0/1 array) and return the indexes of the alleles to flip
+    """
+    rates = np.where(alleles == 0, zero_to_one, one_to_zero)
+    return np.flatnonzero(rng.uniform(0, 1, size=len(alleles)) <= rates)
+
+def flip_line(line, zero_to_one, one_to_zero, rng):
+    """
+    Flip the alleles of one variant line (bytes), rolling a die per haplotype (allele 1 then allele 2 of every
+    sample). Returns the noisy line, its position and the (hap, original allele) arrays of the flipped haplotypes.
+
+    Lines whose genotype columns are all phased biallelic "a|b" are handled as a (samples x 4) byte array (each
+    genotype plus its separator); any other line is parsed one genotype at a time.
+    """
+    fields = line.rstrip(b"\r\n").split(b"\t", 9)
+    genotypes = fields[9] + b"\t"
+    num_samples = len(genotypes) // 4
+    gt = np.frombuffer(genotypes, dtype=np.uint8)
+    if fields[8] == b"GT" and len(gt) == 4 * num_samples:
+        gt = gt.reshape(num_samples, 4)
+        codes = gt[:, (0, 2)] - ord("0")
+        if (codes <= 1).all() and (gt[:, 1] == ord("|")).all() and (gt[:, 3] == ord("\t")).all():
+            alleles = codes.reshape(-1)
+            haps = flip_alleles(alleles, zero_to_one, one_to_zero, rng)
+            new_gt = gt.copy()
+            new_gt[haps // 2, 2 * (haps % 2)] ^= 1
+            new_line = b"\t".join(fields[:9]) + b"\t" + new_gt.tobytes()[:-1] + b"\n"
+            return new_line, int(fields[1]), haps, alleles[haps]
+    toks = fields[9].split(b"\t")
+    alleles = np.array([[int(t[0:1]), int(t[2:3])] for t in toks], dtype=np.uint8).reshape(-1)
+    haps = flip_alleles(alleles, zero_to_one, one_to_zero, rng)
+    new_alleles = alleles.copy()
+    new_alleles[haps] ^= 1
+    gts = [f"{a}|{b}".encode() for a, b in new_alleles.reshape(-1, 2).tolist()]
+    return b"\t".join(fields[:9] + gts) + b"\n", int(fields[1]), haps, alleles[haps]
+
+def noise_chunk(zero_to_one, one_to_zero, entropy, chunk_lines):
+    """
+    Flip the alleles of a chunk of variant lines with the chunk's own random stream.
+    Returns the noisy bytes of the chunk and the DataFrame of its edits
+    """
+    chunk, lines = chunk_lines
+    rng = chunk_rng(entropy, chunk)
+    noisy = []
+    positions = []
+    haps = []
+    alleles = []
+    for line in lines:
+        new_line, pos, line_haps, line_alleles = flip_line(line, zero_to_one, one_to_zero, rng)
+        noisy.append(new_line)
+        positions.append(np.full(len(line_haps), pos, dtype=np.int64))
+        haps.append(line_haps)
+        alleles.append(line_alleles)
+    edits = pd.DataFrame({'pos': np.concatenate(positions), 'hap': np.concatenate(haps),
+                          'allele': np.concatenate(alleles)})
+    return b"".join(noisy), edits
+
+def chunks(f, chunk_size):
+    """
+    Yields (chunk number, lines) for every chunk of chunk_size lines of f
+    """
+    chunk = 0
+    while True:
+        lines = list(islice(f, chunk_size))
+        if not lines:
+            return
+        yield chunk, lines
+        chunk += 1
+
+def open_vcf(filename):
+    """
+    Open a VCF file for reading bytes, decompressing it if it is gzip or BGZF compressed
+    """
+    with open(filename, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    return gzip.open(filename, "rb") if compressed else open(filename, "rb")
+
+class BgzfWriter:
+    """
+    Writes a BGZF file (the blocked gzip of bgzip/tabix): a series of gzip members, each holding at most
+    BLOCK_SIZE bytes and recording its compressed size, followed by the standard empty EOF block
+    """
+    BLOCK_SIZE = 0xff00
+    EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+    def __init__(self, filename, level=6):
+        self.f = open(filename, "wb")
+        self.level = level
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:self.BLOCK_SIZE]))
+            del self.buffer[:self.BLOCK_SIZE]
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2,
+                             len(compressed) + 25)
+        self.f.write(header + compressed + struct.pack("<II", zlib.crc32(data), len(data)))
+
+    def close(self):
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+        self.f.write(self.EOF_BLOCK)
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_output(filename):
+    """
+    Open a VCF file for writing bytes, BGZF compressed if its name ends with .gz
+    """
+    return BgzfWriter(filename) if filename.endswith(".gz") else open(filename, "wb")
+
+def add_noise(vcf_file, noisy_file, edits_file, zero_to_one, one_to_zero, entropy, chunk_size=10000, workers=1):
+    """
+    Add noise to every variant line of vcf_file, processing chunks of chunk_size lines on a pool of workers, or in
+    this process for a single worker. Chunks are written in order, so the noisy file and the edits file only
+    depend on the seed, never on the number of workers. The edits are appended to the CSV chunk by chunk
+    """
+    add_chunk_noise = partial(noise_chunk, zero_to_one, one_to_zero, entropy)
+    with open_vcf(vcf_file) as f, open_output(noisy_file) as nf, open(edits_file, 'w') as ef, \
+            (multiprocessing.Pool(workers) if workers > 1 else contextlib.nullcontext()) as pool:
+        ef.write("pos,hap,allele\n")
+        variant_lines = iter(())
+        for line in f:
+            if line.startswith(b'#'):
+                nf.write(line)
+            else:
+                variant_lines = _prepend(line, f)
+                break
+        lines = chunks(variant_lines, chunk_size)
+        for noisy, edits in imap_bounded(pool, add_chunk_noise, lines, 4 * workers):
+            nf.write(noisy)
+            edits.to_csv(ef, index=False, header=False)
+
+def _prepend(line, lines):
+    """
+    The iterator over line followed by lines
+    """
+    yield line
+    yield from lines
 
 def main():
-    vcf_file = sys.argv[1]
-    noisy_file = "with-error"+sys.argv[1]
-    save=[]
-    with open(vcf_file, 'r') as f:
-        with open(noisy_file, 'w') as nf:
-            for line in f:
-                if line.startswith('#'):
-                    nf.write(line)
-                else:
-                    toks = line.split("\t")
-                    gt_data = toks[9:]
-                    new_toks = list(toks[:9])
-                    for i,t in enumerate(gt_data):
-                        allele1 = int(t[0])
-                        allele2 = int(t[2])
-                        if flip(allele1):
-                            save.append({'pos':toks[1],'hap':2*(i),'allele':allele1})
-                            new_allele=1 if allele1==0 else 0
-                            repl_str=str(new_allele) + "|"
-                        else:
-                            repl_str=str(allele1) + "|"
-
-                        if flip(allele2):
-                            save.append({'pos':toks[1],'hap':2*(i)+1,'allele':allele2})
-                            new_allele2=1 if allele2==0 else 0
-                            repl_str+=str(new_allele2)
-                        else:
-                            repl_str+=str(allele2)
-
-                        new_toks.append(repl_str)
-                    new_line = "\t".join(new_toks) + "\n"
-                    nf.write(new_line)
-    
-    df = pd.DataFrame(save)
-    df.to_csv("edits"+sys.argv[1]+".csv", index=False)
+    parser = argparse.ArgumentParser(description="add genotyping errors to a phased vcf file")
+    parser.add_argument("vcf_file", help="The input VCF file")
+    parser.add_argument("-p", "--zero-to-one", type=float, default=0.000379,
+        help="The probability of flipping a 0 to a 1 (per site)")
+    parser.add_argument("-n", "--one-to-zero", type=float, default=0.063983,
+        help="The probability of flipping a 1 to a 0 (per site)")
+    parser.add_argument("--seed", type=int, default=None,
+        help="Seed for the random number generators; the same seed gives the same output for any number of workers")
+    parser.add_argument("-j", "--workers", type=int, default=1,
+        help="Number of worker processes adding noise to chunks of variant lines")
+    parser.add_argument("-c", "--chunk_size", type=int, default=10000,
+        help="Number of variant lines per chunk; every chunk draws from its own random stream spawned from the seed")
+    parser.add_argument("-o", "--output", default=None,
+        help="The output VCF file, BGZF compressed if it ends with .gz (default: with-error<vcf_file>)")
+    parser.add_argument("-e", "--edits", default=None,
+        help="The output CSV of the flipped alleles (default: edits<vcf_file>.csv)")
+    args = parser.parse_args()
+
+    directory, name = os.path.split(args.vcf_file)
+    noisy_file = args.output if args.output is not None else os.path.join(directory, "with-error"+name)
+    edits_file = args.edits if args.edits is not None else os.path.join(directory, "edits"+name+".csv")
+    entropy = np.random.SeedSequence(args.seed).entropy
+    add_noise(args.vcf_file, noisy_file, edits_file, args.zero_to_one, args.one_to_zero, entropy, args.chunk_size,
+              args.workers)
     return None
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
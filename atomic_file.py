@@ -0,0 +1,19 @@
+# Writing files so that a reader, or a run resumed after a crash, never sees a partial file
+
+import contextlib
+import os
+
+@contextlib.contextmanager
+def atomic_write(filename):
+    """
+    Yields a temporary name to write filename under; the temporary file is renamed to filename once the block
+    finishes, or removed if the block raises
+    """
+    temp_filename = f"{filename}.tmp{os.getpid()}"
+    try:
+        yield temp_filename
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_filename)
+        raise
+    os.replace(temp_filename, filename)
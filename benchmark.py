@@ -0,0 +1,223 @@
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import pyigd
+import BKTree
+import collate_results
+import columnar
+import find_errors
+import reference_data
+
+# Benchmarks of the BK tree and the find_errors/collate_results stages on synthetic data, since the real data
+# cannot be shared. Every run writes one JSON record, so results can be compared across commits
+
+def synthetic_haplotypes(num_haplotypes,window_len,num_founders=20,segment_len=200,error_rate=0.001,seed=0):
+    """
+    Returns a (num_haplotypes x window_len) matrix of 0/1 alleles with IBD-like structure: every haplotype is a
+    mosaic of segments copied from a small set of founder haplotypes, with alleles flipped at error_rate
+    """
+    rng = np.random.default_rng(seed)
+    founders = rng.integers(0, 2, size=(num_founders, window_len), dtype=np.uint8)
+    haplotypes = np.empty((num_haplotypes, window_len), dtype=np.uint8)
+    for h in range(num_haplotypes):
+        start = 0
+        while start < window_len:
+            end = start + int(rng.integers(segment_len // 2, segment_len * 2))
+            haplotypes[h, start:end] = founders[rng.integers(num_founders), start:end]
+            start = end
+    haplotypes ^= (rng.random(haplotypes.shape) < error_rate).astype(np.uint8)
+    return haplotypes
+
+def build_tree(packed):
+    """
+    Build a BK tree (and its exact-match index) over packed haplotypes, with individual indices as elements
+    """
+    root_node = BKTree.BKTreeNode.make_empty()
+    exact_index = {}
+    for i,vector in enumerate(packed):
+        BKTree.bk_tree_insert(root_node, [i // 2], vector, BKTree.popcount_distance, exact_index)
+    return root_node, exact_index
+
+def benchmark_batch_lookup(num_haplotypes,window_len,num_queries,error_rate,seed):
+    """
+    Time the per-query bk_tree_lookup() loop against bk_tree_lookup_batch() for the same queries
+    """
+    packed = BKTree.pack_matrix(synthetic_haplotypes(num_haplotypes, window_len, error_rate=error_rate, seed=seed))
+    root_node, exact_index = build_tree(packed)
+    rng = np.random.default_rng(seed)
+    query_indices = rng.choice(num_haplotypes, size=min(num_queries, num_haplotypes), replace=False)
+    skips = [{int(i) // 2} for i in query_indices]
+
+    start_time = time.time()
+    single = [BKTree.bk_tree_lookup(root_node, packed[i], BKTree.popcount_distance, skip, exact_index)
+              for i, skip in zip(query_indices, skips)]
+    single_time = time.time() - start_time
+
+    start_time = time.time()
+    batch, _ = BKTree.bk_tree_lookup_batch(root_node, packed[query_indices], skips, exact_index)
+    batch_time = time.time() - start_time
+
+    identical = all(s[1] == b[1] and [id(x) for x in s[0]] == [id(x) for x in b[0]] for s, b in zip(single, batch))
+    return {'haplotypes': num_haplotypes, 'window_len': window_len, 'queries': len(query_indices),
+            'unique_vectors': len(exact_index), 'per_query_seconds': single_time, 'batch_seconds': batch_time,
+            'speedup': single_time / batch_time if batch_time else float('inf'), 'identical': identical}
+
+def write_igd(filename,haplotypes,spacing=100):
+    """
+    Write a (num_haplotypes x num_variants) allele matrix as a phased diploid IGD file, one variant every spacing
+    base pairs
+    """
+    with open(filename, "wb") as f:
+        writer = pyigd.IGDWriter(f, haplotypes.shape[0] // 2)
+        writer.write_header()
+        for v in range(haplotypes.shape[1]):
+            writer.write_variant((v+1) * spacing, "A", "G", np.flatnonzero(haplotypes[:, v]).tolist())
+        writer.write_index()
+        writer.write_variant_info()
+        writer.out.seek(0)
+        writer.write_header()
+
+def synthetic_reference(num_haplotypes):
+    """
+    Reference data for synthetic haplotypes: sample names are the individual indices, every individual is a trio
+    member that is its own child, and its only relative is itself
+    """
+    num_individuals = num_haplotypes // 2
+    samp_names = [str(i) for i in range(num_individuals)]
+    return reference_data.ReferenceData(samp_names=samp_names,
+                                        sample_ids={name: i for i, name in enumerate(samp_names)},
+                                        relative_offsets=np.arange(num_individuals+1, dtype=np.int64),
+                                        relative_ids=np.arange(num_individuals, dtype=np.int64),
+                                        trio_set=set(range(num_individuals)),
+                                        child_finder={name: [name] for name in samp_names})
+
+class CountingDistance:
+    """
+    Wraps a distance function and counts its calls
+    """
+    def __init__(self,distance):
+        self.distance = distance
+        self.calls = 0
+
+    def __call__(self,vector1,vector2):
+        self.calls += 1
+        return self.distance(vector1, vector2)
+
+def git_commit():
+    """
+    The commit of the code being benchmarked, or None outside of a git checkout
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark_pipeline(num_haplotypes,window_len,num_queries,error_rate,seed):
+    """
+    Time every stage of find_errors and collate_results on one synthetic window: parsing the window from an IGD
+    file, building the BK tree, the batched lookups of num_queries queries (plus the distance calls per query of
+    the per-query lookup), the consensus/diff collation and the scoring against ground truth edits
+    """
+    haplotypes = synthetic_haplotypes(num_haplotypes, window_len, error_rate=error_rate, seed=seed)
+    rng = np.random.default_rng(seed)
+    query_indices = np.sort(rng.choice(num_haplotypes, size=min(num_queries, num_haplotypes), replace=False))
+    record = {'haplotypes': num_haplotypes, 'window_len': window_len, 'error_rate': error_rate,
+              'queries': len(query_indices), 'seed': seed}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        igd_file = os.path.join(workdir, "synthetic.igd")
+        write_igd(igd_file, haplotypes)
+        start_time = time.time()
+        with pyigd.IGDFile(igd_file) as igd:
+            packed = find_errors.load_window(igd, 0, window_len)
+        record['parse_seconds'] = time.time() - start_time
+
+        start_time = time.time()
+        tree = find_errors.build_tree(packed, 0, window_len)
+        record['tree_build_seconds'] = time.time() - start_time
+        record['unique_vectors'] = tree.num_nodes
+
+        skips = [{int(i) // 2} for i in query_indices]
+        start_time = time.time()
+        lookups, _ = BKTree.flat_bk_tree_lookup_batch(tree, packed[query_indices], skips,
+                                                      BKTree.flat_exact_index(tree))
+        record['lookup_seconds'] = time.time() - start_time
+        record['lookup_seconds_per_query'] = record['lookup_seconds'] / max(len(query_indices), 1)
+
+        root_node, exact_index = build_tree(packed)
+        distance = CountingDistance(BKTree.popcount_distance)
+        for i, skip in zip(query_indices, skips):
+            BKTree.bk_tree_lookup(root_node, packed[i], distance, skip, exact_index)
+        record['distance_calls_per_query'] = distance.calls / max(len(query_indices), 1)
+
+        # The collated file and collate_results.collate() work on collated_{index}.col in the working directory
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            start_time = time.time()
+            with columnar.ColumnarWriter(f"{find_errors.collated_name(0)}.col", 0, window_len, window_len,
+                                         tree.vectors) as writer:
+                find_errors.write_columnar_rows(writer, packed, tree, query_indices, lookups,
+                                                synthetic_reference(num_haplotypes), 0, window_len)
+            collate_seconds = time.time() - start_time
+            record['collate_rows_per_second'] = len(query_indices) / collate_seconds if collate_seconds else None
+
+            errors = np.argwhere(rng.random((num_haplotypes, window_len)) < error_rate)
+            edits_csv = os.path.join(workdir, "edits.csv")
+            pd.DataFrame({'igd_index': errors[:, 1], 'child_sample_name': errors[:, 0] // 2}).to_csv(edits_csv,
+                                                                                                  index=False)
+            collate_results.get_edits(edits_csv)
+            start_time = time.time()
+            collate_results.collate(edits_csv, 0)
+            score_seconds = time.time() - start_time
+            record['score_rows_per_second'] = len(query_indices) / score_seconds if score_seconds else None
+        finally:
+            os.chdir(cwd)
+    return record
+
+def sweep(num_haplotypes,window_lens,error_rates,num_queries,seed):
+    """
+    Yields the benchmark_pipeline() record of every combination of haplotype count, window width and error rate
+    """
+    for n, window_len, error_rate in itertools.product(num_haplotypes, window_lens, error_rates):
+        yield benchmark_pipeline(n, window_len, num_queries, error_rate, seed)
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the BK tree and the find_errors pipeline stages on synthetic haplotypes, writing one JSON record per run")
+    parser.add_argument('-n', '--num_haplotypes', type=int, nargs='+', default=[20000], help="number(s) of haplotypes in the tree")
+    parser.add_argument('-l', '--window_len', type=int, nargs='+', default=[500], help="number(s) of variants per haplotype")
+    parser.add_argument('-q', '--num_queries', type=int, default=500, help="number of query haplotypes")
+    parser.add_argument('-e', '--error_rate', type=float, nargs='+', default=[0.001], help="per-allele error rate(s)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed for the synthetic data")
+    parser.add_argument('-o', '--output', default=None, help="JSON-lines file to append the records to (default: stdout)")
+    parser.add_argument('--batch_comparison', action='store_true', help="instead, compare the per-query and batched pointer-tree lookups")
+    args = parser.parse_args()
+
+    if args.batch_comparison:
+        for n, window_len, error_rate in itertools.product(args.num_haplotypes, args.window_len, args.error_rate):
+            result = benchmark_batch_lookup(n, window_len, args.num_queries, error_rate, args.seed)
+            for key, value in result.items():
+                print(f"{key}: {value}")
+        return
+
+    run = {'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"), 'git_commit': git_commit(),
+           'numpy': np.__version__, 'python': sys.version.split()[0]}
+    out = open(args.output, "a") if args.output is not None else sys.stdout
+    try:
+        for record in sweep(args.num_haplotypes, args.window_len, args.error_rate, args.num_queries, args.seed):
+            out.write(json.dumps({**run, **record}) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
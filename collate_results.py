@@ -2,80 +2,199 @@ import pandas as pd
 import argparse
 import multiprocessing
 import pickle
-
-def calculate_metrics(df):
+import os
+import glob
+import numpy as np
+import columnar
+import edits
+import manifest
+import reference_data
+
+def error_keys(child_names,positions):
     """
-    Returns the number of true errors, predicted errors, and overlap
+    Encode (child sample name, igd variant index) pairs as single int64 keys so that they can be compared with
+    vectorized set operations
     """
-    num_true_errors = 0
-    num_predicted_errors = 0
-    overlap = 0
+    return (np.asarray(child_names, dtype=np.int64) << 32) | np.asarray(positions, dtype=np.int64)
 
-    for i,row in df.iterrows():
-        true_err = row.error_positions
-        predicted = set(row.diff_markers)
-        predicted_errors = [int(x) for x in predicted]
-        true_errors = [int(x) for x in true_err]
+def calculate_metrics(true_keys,predicted_keys):
+    """
+    Returns the number of true errors, predicted errors, and overlap. true_keys has one key per ground truth edit
+    (so an edit listed twice counts twice), predicted_keys are the distinct predicted errors
+    """
+    overlap = int(np.isin(true_keys, predicted_keys).sum())
+    return len(true_keys),len(predicted_keys),overlap
 
-        num_true_errors += len(true_errors)
-        num_predicted_errors += len(predicted_errors)
+# Ground truth edits already loaded by this process, keyed by the input files
+_edits = {}
 
-        for err in true_errors:
-            if err in predicted_errors:
-                overlap += 1
-    return num_true_errors,num_predicted_errors,overlap
+def load_edits(errors_csv,samples=None,child_find=None):
+    """
+    Returns the ground truth edits as arrays (igd_index, child_sample_name), sorted by igd_index. errors_csv is
+    either a CSV with those columns, or the binary edits file written by add_errors_igd.py; the latter records
+    haplotypes, which are mapped to sample names with the samples file and, if child_find is given, restricted to
+    the trio children
+    """
+    if not edits.is_edits_file(errors_csv):
+        errors = pd.read_csv(errors_csv, usecols=['igd_index','child_sample_name'])
+        igd_index = errors['igd_index'].to_numpy(dtype=np.int64)
+        child_sample_name = errors['child_sample_name'].to_numpy(dtype=np.int64)
+    else:
+        if samples is None:
+            raise ValueError(f"the samples file is needed to read the binary edits file {errors_csv}")
+        records = edits.read_edits(errors_csv)
+        sample_names = np.array(reference_data.read_samples(samples), dtype=np.int64)
+        igd_index = records['igd_index']
+        child_sample_name = sample_names[records['hap'] // 2]
+        if child_find is not None:
+            with open(child_find,"rb") as c:
+                children = {int(child) for names in pickle.load(c).values() for child in names}
+            is_child = np.isin(child_sample_name, np.array(sorted(children), dtype=np.int64))
+            igd_index, child_sample_name = igd_index[is_child], child_sample_name[is_child]
+    order = np.argsort(igd_index, kind='stable')
+    return igd_index[order], child_sample_name[order]
+
+def get_edits(errors_csv,samples=None,child_find=None):
+    """
+    Returns the sorted ground truth edits, loading them only the first time they are requested in this process.
+    Loading them in the parent before creating a fork()ed pool shares them with all the workers
+    """
+    key = (errors_csv,samples,child_find)
+    if key not in _edits:
+        _edits[key] = load_edits(errors_csv,samples,child_find)
+    return _edits[key]
 
-def collate(errors_csv,index):
+def load_collated(index,directory="."):
+    """
+    Returns the collated results of a window from find_errors, either its columnar collated_{index}.col file (only
+    the columns needed here are decoded) or its pickled DataFrame collated_{index}.pkl, in directory
+    """
+    name = os.path.join(directory, f"collated_{index}")
+    if os.path.exists(f"{name}.col"):
+        columns = columnar.read_columnar(f"{name}.col")
+        return pd.DataFrame({
+            'start_index': columns['start_index'],
+            'end_index': columns['end_index'],
+            'child_name(s)': [[str(c) for c in children.tolist()] for children in
+                              columnar.split_csr(columns['child_offsets'], columns['child_names'])],
+            'diff_markers': [d.tolist() for d in columnar.split_csr(columns['diff_offsets'], columns['diff_markers'])],
+        })
+    with open(f"{name}.pkl","rb") as f:
+        return pickle.load(f)
+
+def collate(errors_csv,index,samples=None,child_find=None,directory="."):
     """
     Compare predicted errors with ground truth errors for each haplotype  
     """
-    with open(f"collated_{index}.pkl","rb") as f:
-        results = pickle.load(f)
-    with open(errors_csv) as c:
-        edits = pd.read_csv(c)
-
-    results = results.explode('child_name(s)')
-    results.rename(columns={'child_name(s)': 'child_sample_name'}, inplace=True)
-    grouped_results = results.groupby('child_sample_name')['diff_markers'].agg(lambda x: sum(x, []))
-    grouped_results_df = grouped_results.reset_index()
-    grouped_results_df['child_sample_name'] = grouped_results_df['child_sample_name'].astype(int)
+    results = load_collated(index,directory)
+    igd_index, child_sample_name = get_edits(errors_csv,samples,child_find)
 
     start_index = int(results['start_index'].iloc[0])
     end_index = int(results['end_index'].iloc[0])
 
-    within = edits[(edits.igd_index>= start_index) & (edits.igd_index < end_index)].copy()
-    within['error_positions'] = within['igd_index']
-    grouped_hap = within.groupby('child_sample_name')['error_positions'].apply(list)
-    grouped_hap_df = grouped_hap.reset_index()
+    # The edits within the window are a contiguous slice of the sorted edits
+    lo, hi = np.searchsorted(igd_index, [start_index, end_index], side='left')
+    true_keys = error_keys(child_sample_name[lo:hi], igd_index[lo:hi])
 
-    final_results = pd.merge(grouped_results_df, grouped_hap_df, on='child_sample_name', how='outer')
-    final_results['error_positions'] = final_results['error_positions'].apply(lambda x: x if isinstance(x, list) else [])
-    final_results['diff_markers'] = final_results['diff_markers'].apply(lambda x: x if isinstance(x, list) else [])
-    
-    #with open(f"final_results_{index}.pkl","wb") as f:
-        #pickle.dump(final_results,f)
+    # Every query's predicted errors count for each of its associated children
+    predicted_keys = [np.add.outer(error_keys([int(c) for c in children], 0), np.asarray(diffs, dtype=np.int64)).ravel()
+                      for children, diffs in zip(results['child_name(s)'], results['diff_markers'])]
+    predicted_keys = np.unique(np.concatenate(predicted_keys)) if predicted_keys else np.zeros(0, dtype=np.int64)
 
-    return calculate_metrics(final_results)
+    return calculate_metrics(true_keys,predicted_keys)
     
-def get_input(csv_file):
+def collated_indices():
+    """
+    Returns the sorted indices of all the windows that find_errors wrote results for
+    """
+    indices = set()
+    for filename in glob.glob("collated_*.col") + glob.glob("collated_*.pkl"):
+        index = os.path.basename(filename)[len("collated_"):-len(".col")]
+        if index.isdigit():
+            indices.add(int(index))
+    return sorted(indices)
+
+def shard_directories(shard_dirs,manifest_name="manifest.json"):
+    """
+    Returns the map from window index to the directory that holds its results, for the output directories of all
+    the shards of a find_errors.py --shard run, whose manifests are named manifest_name. Raises ValueError unless
+    the shards are all from the same run (same inputs and window table, and one of each shard number) and together
+    cover every window with finished, unchanged results
+    """
+    manifests = []
+    for directory in shard_dirs:
+        run_manifest = manifest.read_manifest(os.path.join(directory, manifest_name))
+        if run_manifest is None or "shard" not in run_manifest:
+            raise ValueError(f"{directory} has no find_errors.py manifest")
+        manifests.append((directory, run_manifest))
+
+    # Every window key depends on all the inputs, so windows with the same range have the same key in the same run
+    first_directory, first = manifests[0]
+    fingerprint = lambda m: (manifest.window_key(m["inputs"],0,0), m["inputs"]["window_size"], m["num_windows"])
+    for directory, run_manifest in manifests[1:]:
+        if fingerprint(run_manifest) != fingerprint(first):
+            raise ValueError(f"{directory} is from a different run than {first_directory}")
+    num_shards = first["shard"]["num_shards"]
+    shards = sorted(m["shard"]["shard"] for _, m in manifests)
+    if shards != list(range(num_shards)) or any(m["shard"]["num_shards"] != num_shards for _, m in manifests):
+        raise ValueError(f"expected one directory for each of the {num_shards} shards, got shards {shards}")
+
+    window_dirs = {}
+    unfinished = []
+    for directory, run_manifest in manifests:
+        for index in run_manifest["shard"]["windows"]:
+            entry = run_manifest["windows"].get(str(index))
+            if entry is None or not manifest.is_finished(run_manifest,index,entry["start_index"],entry["end_index"],
+                                                         entry["output"],directory):
+                unfinished.append(index)
+            window_dirs[index] = directory
+    missing = sorted(set(range(first["num_windows"])) - set(window_dirs))
+    problems = []
+    if missing:
+        problems.append(f"windows not covered by the shards: {missing}")
+    if unfinished:
+        problems.append(f"windows not finished: {sorted(unfinished)}")
+    if problems:
+        raise ValueError("; ".join(problems))
+    return window_dirs
+
+def get_input(csv_file,samples=None,child_find=None,window_dirs=None):
     """
-    Returns iterable for starmap()
+    Returns iterable for starmap(). window_dirs maps each window's index to the directory with its results (see
+    shard_directories()); by default the windows are those with results in the current directory
     """
-    num_windows =  1509
+    if window_dirs is None:
+        window_dirs = {index: "." for index in collated_indices()}
+    index = sorted(window_dirs)
+    num_windows = len(index)
 
     csv_files = [csv_file for _ in range(num_windows)]
-    index = list(range(num_windows))
+    samples_files = [samples for _ in range(num_windows)]
+    child_find_files = [child_find for _ in range(num_windows)]
+    directories = [window_dirs[i] for i in index]
 
-    return zip(csv_files,index)
+    return zip(csv_files,index,samples_files,child_find_files,directories)
+
+def load_all_edits(edits_inputs):
+    """
+    Pool initializer that loads all the (errors_csv, samples, child_find) edits inputs
+    """
+    for edits_input in edits_inputs:
+        get_edits(*edits_input)
 
 def multipool(input):
+    input = list(input)
     number_of_cores = 100
 
     num_true_errors = 0
     num_predicted_errors = 0
     overlap = 0
 
-    with multiprocessing.Pool(number_of_cores) as pool:
+    # Load the edits once here; fork()ed workers inherit them and spawned workers load them once each
+    edits_inputs = {(csv_file,samples,child_find) for csv_file, _, samples, child_find, _ in input}
+    load_all_edits(edits_inputs)
+
+    with multiprocessing.Pool(number_of_cores, initializer=load_all_edits, initargs=(edits_inputs,)) as pool:
         # distribute computations and collect results:
 
         results = pool.starmap(collate, input)
@@ -96,10 +215,22 @@ def multipool(input):
 
 def main():
     parser = argparse.ArgumentParser(description="match admixed haplotypes with reference panel in windows using BK Trees")
-    parser.add_argument('-c', '--csv_file', type=str, required=True, help="csv file with errors")
+    parser.add_argument('-c', '--csv_file', type=str, required=True, help="csv file with errors, or the binary edits file from add_errors_igd.py")
+    parser.add_argument('-s','--samples',default=None,help="txt file with a list of all sample names in the igd file (needed for a binary edits file)")
+    parser.add_argument('-d','--child_find',default=None,help="pickle file of dictionary where keys are trio samples and values are the associated child; restricts a binary edits file to the children")
+    parser.add_argument('--shards',nargs='+',default=None,help="merge the output directories of all the shards of a find_errors.py --shard run, after checking that they cover every window; the results are written to the current directory")
+    parser.add_argument('--manifest',default="manifest.json",help="name of the manifest in each of the --shards directories, as given to find_errors.py --manifest")
     args = parser.parse_args()
-
-    multipool(get_input(args.csv_file))
+    if args.samples is None and edits.is_edits_file(args.csv_file):
+        parser.error(f"-s/--samples is needed to read the binary edits file {args.csv_file}")
+
+    window_dirs = None
+    if args.shards is not None:
+        try:
+            window_dirs = shard_directories(args.shards,args.manifest)
+        except ValueError as e:
+            parser.error(str(e))
+    multipool(get_input(args.csv_file,args.samples,args.child_find,window_dirs))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,182 @@
+from typing import List, Dict, Any
+import contextlib
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import BKTree
+from atomic_file import atomic_write
+
+# Per-query columns of a chunk, in the order they are stored. Each column is one .npy array; the *_offsets
+# columns are CSR offsets (relative to the chunk) into the column that follows them. "complete" is False for the
+# queries whose search ran out of its budget (see BKTree.bk_tree_lookup_batch()); version 1 files do not have it.
+CHUNK_COLUMNS = ["hap_index", "sample_id", "edit_distance", "exact", "query", "consensus",
+                 "match_offsets", "match_ids", "diff_offsets", "diff_markers", "child_offsets", "child_names",
+                 "table_ids", "table_vectors", "complete"]
+_CSR_COLUMNS = {"match_offsets": "match_ids", "diff_offsets": "diff_markers", "child_offsets": "child_names"}
+FORMAT_NAME = "collated-columnar"
+FORMAT_VERSION = 2
+
+def csr(lists):
+    """
+    Returns the CSR (offsets, values) arrays of a list of lists of integers
+    """
+    offsets = np.zeros(len(lists)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in lists])
+    values = np.fromiter((v for x in lists for v in x), dtype=np.int64, count=int(offsets[-1]))
+    return offsets, values
+
+class ColumnarWriter:
+    """
+    Streams the collated results of a window into a compact columnar file. Rows are written in chunks of
+    whole columns (see write_rows()), so nothing but the current chunk is held in memory. The query and
+    consensus are stored as packed bits, and matches as ids into the window's table of unique haplotypes; only
+    the table rows that are referenced are stored, each the first time it is referenced.
+
+    The file is a sequence of .npy arrays: a header (JSON as uint8), then the CHUNK_COLUMNS of every chunk.
+    It is written under a temporary name and renamed by close(), so a partial file is never visible.
+    """
+    def __init__(self,filename,start_index,end_index,window_len,unique_vectors):
+        self.filename = filename
+        self.replace = contextlib.ExitStack()
+        self.temp_filename = self.replace.enter_context(atomic_write(filename))
+        self.unique_vectors = unique_vectors
+        self.written_ids = set()
+        self.num_rows = 0
+        self.f = open(self.temp_filename, "wb")
+        header = {"format": FORMAT_NAME, "version": FORMAT_VERSION, "start_index": int(start_index),
+                  "end_index": int(end_index), "window_len": int(window_len), "words": (window_len+63)//64}
+        np.save(self.f, np.frombuffer(json.dumps(header).encode(), dtype=np.uint8))
+
+    def write_rows(self,hap_index,sample_id,edit_distance,exact,query,consensus,match_ids,diff_offsets,diff_markers,
+                   child_names,complete=None):
+        """
+        Write a chunk of rows. query and consensus are (rows x words) packed matrices, diff_offsets and
+        diff_markers are the CSR of the diff markers, and match_ids and child_names are lists of lists
+        """
+        if complete is None:
+            complete = np.ones(len(hap_index), dtype=bool)
+        match_offsets, match_ids = csr(match_ids)
+        child_offsets, child_names = csr(child_names)
+        table_ids = np.array(sorted(set(match_ids.tolist()) - self.written_ids), dtype=np.int64)
+        self.written_ids.update(table_ids.tolist())
+        columns = {"hap_index": hap_index, "sample_id": sample_id, "edit_distance": edit_distance, "exact": exact,
+                   "query": query, "consensus": consensus, "match_offsets": match_offsets, "match_ids": match_ids,
+                   "diff_offsets": diff_offsets, "diff_markers": diff_markers, "child_offsets": child_offsets,
+                   "child_names": child_names, "table_ids": table_ids,
+                   "table_vectors": np.asarray(self.unique_vectors[table_ids], dtype="<u8"),
+                   "complete": np.asarray(complete, dtype=bool)}
+        for name in CHUNK_COLUMNS:
+            np.save(self.f, np.asarray(columns[name]))
+        self.num_rows += len(hap_index)
+
+    def close(self):
+        self.f.close()
+        self.replace.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            self.replace.__exit__(exc_type, *args)
+
+def read_columnar(filename) -> Dict[str, Any]:
+    """
+    Read a file written by ColumnarWriter. Returns the header fields plus every column concatenated over all
+    chunks (CSR offsets rebased to the whole file), and "table", a map from unique haplotype id to its packed
+    vector
+    """
+    with open(filename, "rb") as f:
+        header = json.loads(np.load(f).tobytes().decode())
+        if header.get("format") != FORMAT_NAME:
+            raise ValueError(f"{filename} is not a columnar collated file")
+        stored = CHUNK_COLUMNS if header["version"] >= 2 else CHUNK_COLUMNS[:-1]
+        chunks = {name: [] for name in CHUNK_COLUMNS}
+        file_size = os.fstat(f.fileno()).st_size
+        while f.tell() < file_size:
+            for name in stored:
+                chunks[name].append(np.load(f))
+
+    words = header["words"]
+    result = dict(header)
+    for name in CHUNK_COLUMNS:
+        if name in _CSR_COLUMNS:
+            continue
+        if chunks[name]:
+            result[name] = np.concatenate(chunks[name])
+        elif name in ("query", "consensus", "table_vectors"):
+            result[name] = np.zeros((0, words), dtype="<u8")
+        elif name == "complete":
+            result[name] = np.ones(len(result["hap_index"]), dtype=bool)
+        else:
+            result[name] = np.zeros(0, dtype=bool if name == "exact" else np.int64)
+    for offsets_name in _CSR_COLUMNS:
+        offsets = [np.zeros(1, dtype=np.int64)]
+        base = 0
+        for chunk_offsets in chunks[offsets_name]:
+            offsets.append(chunk_offsets[1:] + base)
+            base += chunk_offsets[-1]
+        result[offsets_name] = np.concatenate(offsets)
+    result["table"] = dict(zip(result.pop("table_ids").tolist(), result.pop("table_vectors")))
+    return result
+
+def merge_columnar(filenames,filename):
+    """
+    Concatenate the columnar files of the same window (e.g. written for disjoint subsets of its queries) into one
+    file, with the rows in the order of filenames. The file is written under a temporary name and then renamed
+    """
+    window = None
+    with atomic_write(filename) as temp_filename, open(temp_filename, "wb") as out:
+        for part in filenames:
+            with open(part, "rb") as f:
+                header = np.load(f)
+                fields = json.loads(header.tobytes().decode())
+                if fields.get("format") != FORMAT_NAME:
+                    raise ValueError(f"{part} is not a columnar collated file")
+                if window is None:
+                    window = (fields["start_index"], fields["end_index"])
+                    np.save(out, header)
+                elif window != (fields["start_index"], fields["end_index"]):
+                    raise ValueError(f"{part} is not from the same window as {filenames[0]}")
+                if fields["version"] != FORMAT_VERSION:
+                    raise ValueError(f"{part} is a version {fields['version']} columnar file")
+                shutil.copyfileobj(f, out)
+
+def split_csr(offsets,values) -> List[np.ndarray]:
+    """
+    Inverse of csr(): the list of per-row arrays
+    """
+    return [values[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+def columnar_to_dataframe(filename,samp_names=None):
+    """
+    Read a columnar collated file into the same DataFrame that the pickle output format holds (sample_name is
+    only filled in if the sample names are given)
+    """
+    columns = read_columnar(filename)
+    window_len = columns["window_len"]
+    unpack = lambda vector: BKTree.unpack_vector(vector, window_len)
+    to_string = lambda vector: ''.join(str(x) for x in unpack(vector))
+    matches = [[unpack(columns["table"][i]) for i in ids.tolist()]
+               for ids in split_csr(columns["match_offsets"], columns["match_ids"])]
+    return pd.DataFrame({
+        'start_index': columns["start_index"],
+        'end_index': columns["end_index"],
+        'query': [to_string(q) for q in columns["query"]],
+        'matches': matches,
+        'edit_distance': columns["edit_distance"],
+        'exact_matches': [m if exact else [] for m, exact in zip(matches, columns["exact"])],
+        'hap_index': columns["hap_index"],
+        'sample_name': [samp_names[i] if samp_names is not None else None for i in columns["sample_id"].tolist()],
+        'child_name(s)': [[str(c) for c in children.tolist()]
+                          for children in split_csr(columns["child_offsets"], columns["child_names"])],
+        'consensus_seq': [to_string(c) for c in columns["consensus"]],
+        'diff_markers': [d.tolist() for d in split_csr(columns["diff_offsets"], columns["diff_markers"])],
+        'neighborhood_size': np.diff(columns["match_offsets"]),
+        'complete': columns["complete"],
+    })
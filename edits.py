@@ -0,0 +1,77 @@
+import numpy as np
+
+# One record per flipped allele: the igd variant index and base-pair position of the variant, the haplotype
+# (sample index in the igd, 0-based; haplotypes 2i and 2i+1 belong to individual i), and the original allele
+EDITS_DTYPE = np.dtype([('igd_index', '<i8'), ('position', '<i8'), ('hap', '<i8'), ('allele', 'u1')])
+EDITS_MAGIC = b"EDITS001"
+
+def edit_records(igd_index,position,haps,alleles):
+    """
+    Returns the EDITS_DTYPE records of the flipped haplotypes haps (with original alleles) of one variant
+    """
+    records = np.empty(len(haps), dtype=EDITS_DTYPE)
+    records['igd_index'] = igd_index
+    records['position'] = position
+    records['hap'] = haps
+    records['allele'] = alleles
+    return records
+
+class EditsWriter:
+    """
+    Collects edit records in memory and appends them to a compact binary edits file (a magic string followed
+    by raw EDITS_DTYPE records) in bulk, whenever more than flush_size records are buffered and on close()
+    """
+    def __init__(self,filename,flush_size=1_000_000):
+        self.f = open(filename, "wb")
+        self.f.write(EDITS_MAGIC)
+        self.flush_size = flush_size
+        self.buffered = []
+        self.num_buffered = 0
+        self.num_written = 0
+
+    def add(self,igd_index,position,haps,alleles):
+        """
+        Record the edits of one variant: haps and alleles are arrays of the flipped haplotypes and their original
+        alleles
+        """
+        if len(haps) == 0:
+            return
+        self.add_records(edit_records(igd_index, position, haps, alleles))
+
+    def add_records(self,records):
+        self.buffered.append(records)
+        self.num_buffered += len(records)
+        if self.num_buffered >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffered:
+            np.concatenate(self.buffered).tofile(self.f)
+            self.num_written += self.num_buffered
+        self.buffered = []
+        self.num_buffered = 0
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def is_edits_file(filename):
+    """
+    True if filename is a binary edits file (rather than a CSV)
+    """
+    with open(filename, "rb") as f:
+        return f.read(len(EDITS_MAGIC)) == EDITS_MAGIC
+
+def read_edits(filename):
+    """
+    Returns all the records of a binary edits file as an EDITS_DTYPE array
+    """
+    if not is_edits_file(filename):
+        raise ValueError(f"{filename} is not a binary edits file")
+    return np.fromfile(filename, dtype=EDITS_DTYPE, offset=len(EDITS_MAGIC))
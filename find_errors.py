@@ -1,39 +1,92 @@
 import pandas as pd
 import BKTree
+import columnar
+import manifest
+import nn_index
+import profile_report
+import reference_data
+from atomic_file import atomic_write
 import argparse
 import pyigd
+import pyigd.readwrite
 import multiprocessing
+import contextlib
+import hashlib
+import heapq
+from typing import NamedTuple, Optional
+import queue
+import shutil
+import struct
+import tempfile
 import time
-import collections
 import pickle
+import os
+import json
+import resource
+import numpy as np
+
+def allele_matrix(strings):
+    """
+    Returns the (len(strings) x length) uint8 matrix of alleles of equal-length strings of 0s and 1s
+    """
+    if len(strings) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    return (np.frombuffer(''.join(strings).encode(), dtype=np.uint8) - ord('0')).reshape(len(strings), -1)
+
+def allele_string(alleles):
+    """
+    Inverse of allele_matrix() for a single row
+    """
+    return (np.asarray(alleles, dtype=np.uint8) + ord('0')).tobytes().decode()
 
 def find_diffs(row):
     """
     Finds the differences between the consensus sequence and the query and returns their indices in a list
     """
-    diff_markers=[row['start_index']+i for i in range(len(row['query'])) if \
-                    row['query'][i] != row['consensus_seq'][i]]
-   
+    query, consensus = allele_matrix([row['query'], row['consensus_seq']])
+    diff_markers = (row['start_index'] + np.flatnonzero(query != consensus)).tolist()
+
     return pd.Series([diff_markers])
 
+def find_diffs_batch(queries,consensus,start_index):
+    """
+    Batched find_diffs() for all the queries of a window: returns, for each row of the query and consensus allele
+    matrices, the list of variant indices where they differ
+    """
+    offsets, diff_markers = diff_csr(queries,consensus,start_index)
+    return [diff_markers[offsets[r]:offsets[r+1]].tolist() for r in range(len(queries))]
+
+def diff_csr(queries,consensus,start_index):
+    """
+    The diff markers of find_diffs_batch() as CSR arrays (offsets, diff_markers)
+    """
+    rows, columns = np.nonzero(queries ^ consensus)
+    offsets = np.searchsorted(rows, np.arange(len(queries)+1))
+    return offsets, start_index + columns
+
 def get_consensus_seq(matches):
     """
     Returns the consensus sequence obtained from nearest neighbor matches. ie the string that concats the most
     common character at each position; ties are broken by using the alternate allele ("1")
     """ 
-    strings=[''.join([str(e) for e in x]) for x in matches]
-    consensus = ''
-    for i in range(len(strings[0])):
-        column = [s[i] for s in strings]
-        counter = collections.Counter(column)
-        most_common = counter.most_common(2)
-        if len(most_common) == 1:
-          consensus += most_common[0][0]
-        elif most_common[1][1] == most_common[0][1]:
-          consensus += "1"
-        else:
-          consensus += most_common[0][0]
-        
+    stacked = np.asarray(matches, dtype=np.uint8).reshape(len(matches), -1)
+    return allele_string(2*stacked.sum(axis=0) >= len(stacked))
+
+def consensus_matrix(neighborhoods,queries):
+    """
+    Batched get_consensus_seq() for all the queries of a window. Each neighborhood is the list of match vectors of
+    the query in the same row of the queries allele matrix; the consensus of each column is computed from the
+    column sums of all the neighborhoods' stacked matches. A query with no matches is its own consensus
+    """
+    sizes = np.array([len(m) for m in neighborhoods], dtype=np.int64)
+    consensus = queries.copy()
+    nonempty = sizes > 0
+    if nonempty.any():
+        stacked = np.concatenate([np.asarray(m, dtype=np.uint8).reshape(len(m), -1) for m in neighborhoods if len(m)])
+        # Rows stacked[offsets[i]:offsets[i+1]] belong to the ith nonempty neighborhood
+        offsets = (np.cumsum(sizes) - sizes)[nonempty]
+        ones = np.add.reduceat(stacked, offsets, axis=0, dtype=np.int64)
+        consensus[nonempty] = 2*ones >= sizes[nonempty, None]
     return consensus
 
 def hamming_distance(vector1, vector2):
@@ -42,101 +95,430 @@ def hamming_distance(vector1, vector2):
     """
     return sum(el1 != el2 for el1, el2 in zip(vector1, vector2))
 
-def write(results,index):
+def collated_name(index,part=0,num_parts=1):
+    """
+    The name (without extension) of the file that a window's results are written to. The parts of a window that
+    was split between several tasks are written to separate files, which merge_parts() joins
+    """
+    if num_parts == 1:
+        return f"collated_{index}"
+    return f"collated_{index}.part{part}of{num_parts}"
+
+def output_file(index,output_format):
+    """
+    The collated file that window index is written to
+    """
+    return f"{collated_name(index)}.{'col' if output_format == 'columnar' else 'pkl'}"
+
+def write(results,name):
     """
-    Write the results into a pickle file
+    Write the results into a pickle file, under a temporary name that is renamed once it is complete
     """
-    with open(f"collated_{index}.pkl","wb") as f:
+    with atomic_write(f"{name}.pkl") as temp_filename, open(temp_filename,"wb") as f:
         pickle.dump(results,f)
 
-def collate(matches,index):
+def write_columnar_rows(writer,haplotypes,nn,hap_indices,lookups,reference,start_index,end_index,complete=None):
+    """
+    Computes the consensus sequences and predicted error positions of a chunk of queries (the rows hap_indices of
+    the packed haplotypes, with their lookups) straight from the packed haplotypes and the nearest-neighbour
+    index's unique vectors, and writes them as rows of a columnar.ColumnarWriter
+    """
+    window_len = end_index-start_index
+    match_ids = [results for results, _, _ in lookups]
+    queries = BKTree.unpack_matrix(haplotypes[hap_indices], window_len)
+    consensus = consensus_matrix([BKTree.unpack_matrix(nn.vectors[ids], window_len) for ids in match_ids], queries)
+    diff_offsets, diff_markers = diff_csr(queries, consensus, start_index)
+    writer.write_rows(hap_index=hap_indices,
+                      sample_id=hap_indices // 2,
+                      edit_distance=np.array([dist_best for _, dist_best, _ in lookups], dtype=np.int64),
+                      exact=np.array([len(exact) > 0 for _, _, exact in lookups], dtype=bool),
+                      query=haplotypes[hap_indices],
+                      consensus=BKTree.pack_matrix(consensus),
+                      match_ids=match_ids,
+                      diff_offsets=diff_offsets,
+                      diff_markers=diff_markers,
+                      child_names=[[int(c) for c in reference.child_finder.get(reference.samp_names[i // 2], [])]
+                                   for i in hap_indices.tolist()],
+                      complete=complete)
+
+def collate(matches,name):
     """
     Create consensus sequence and find predicted error positions
     """
     results = pd.DataFrame.from_dict(matches)
-    results['consensus_seq'] = results['matches'].apply(lambda x: pd.Series(get_consensus_seq(x)))
-    results['diff_markers'] = results.apply(lambda x: find_diffs(x),axis=1)
+    queries = allele_matrix(results['query'].tolist())
+    consensus = consensus_matrix(results['matches'].tolist(), queries)
+    results['consensus_seq'] = [allele_string(c) for c in consensus]
+    results['diff_markers'] = find_diffs_batch(queries, consensus, matches[0]['start_index'])
     results['neighborhood_size'] = results['matches'].apply(len)
-    write(results,index)
+    results['complete'] = results.pop('complete')
+    write(results,name)
 
-def match(haplotypes,start_index,end_index,samples,relatives,trios,child_find,index):
+def build_tree(haplotypes,start_index,end_index,tree_dir=None):
     """
-    Find nearest neighbors matches for each haplotype
+    Returns the flat BK tree over a window's packed haplotypes, with individual indices as elements. If tree_dir is
+    given then the tree saved there by an earlier run is memory-mapped instead of being rebuilt, or the newly built
+    tree is saved there. Tree files are named after a digest of the haplotypes as well as the window, so a tree_dir
+    reused with another (or a regenerated) igd file builds new trees instead of loading ones that do not match
     """
-    with open(samples,"r") as s: #samples = ukbiobank_header.txt (all sample names of individuals in biobank data)
-        samp_names = s.readline().split()
-
-    with open(relatives,"rb") as r: #relatives = pickle file of dictionary {sample name: close relative sample names to skip when querying the key}
-        skipping_dict = pickle.load(r)
+    tree_file = None
+    if tree_dir is not None:
+        digest = hashlib.blake2b(np.ascontiguousarray(haplotypes).tobytes(), digest_size=16).hexdigest()
+        tree_file = os.path.join(tree_dir, f"tree_{start_index}_{end_index}_{digest}.bkt")
+        if os.path.exists(tree_file):
+            return BKTree.load_flat_bk_tree(tree_file)
 
-    with open(trios,"rb") as t: #trios = pickle file with a set of all the trios indices in the igd
-        trio_set = pickle.load(t)
-    
-    with open(child_find,"rb") as c: #child_find = pickle file of dictionary {trio sample names: associated child sample name(s) in a list} if trio sample is a child then key = value
-        child_finder = pickle.load(c)
-
-    # Initialize an empty BKTreeNode
+    # Initialize an empty BKTreeNode, and the hash index of its vectors that catches identical haplotypes
     root_node = BKTree.BKTreeNode.make_empty()
+    exact_index = {}
 
     #Insert reference vectors into the BK tree
     for i,genotype in enumerate(haplotypes):
-        BKTree.bk_tree_insert(root_node, [samp_names[i // 2]], genotype, hamming_distance)
-
-    #Look up nearest neighbors for each ADMIXgenotype
-    matches=[]
-    for i,query_vector in enumerate(haplotypes):
-        if (i // 2) in trio_set:
-            results, dist_best, exact_matches=BKTree.bk_tree_lookup(root_node, query_vector, hamming_distance, skipping_dict[samp_names[i//2]])
-            matches.append({\
-                    'start_index':start_index,\
-                    'end_index':end_index,\
-                    'query':''.join([str(x) for x in query_vector]),\
-                    'matches':[x.vector for x in results],\
-                    'edit_distance':dist_best, \
-                    'exact_matches':[x.vector for x in exact_matches],\
-                    'hap_index': i,\
-                    'sample_name':samp_names[i//2],\
-                    'child_name(s)': child_finder[samp_names[i//2]]\
-                    })
-            
-    return collate(matches,index)
-
-def window(igd_file,start_index,end_index,samples, relatives,trios,child_find,index):
-    """
-    Create a list of haplotypes for a particular window starting at variant start_index and ending at variant
-    end_index
+        BKTree.bk_tree_insert(root_node, [i // 2], genotype, BKTree.popcount_distance, exact_index)
+
+    tree = BKTree.flatten_bk_tree(root_node)
+    if tree_file is not None:
+        os.makedirs(tree_dir, exist_ok=True)
+        BKTree.save_flat_bk_tree(tree, tree_file)
+    return tree
+
+def build_index(haplotypes,start_index,end_index,tree_dir=None,index_kind="auto"):
     """
+    Returns the nearest-neighbour index (see nn_index.py) over a window's packed haplotypes, with individual indices
+    as elements. index_kind is "bktree", "mih" (multi-index hashing) or "auto", which picks one of them from the
+    window's haplotypes with nn_index.choose_index(). BK trees are cached in tree_dir (see build_tree())
+    """
+    distinct = None
+    if index_kind == "auto":
+        distinct = nn_index.distinct_rows(haplotypes)
+        index_kind = nn_index.choose_index(haplotypes, end_index-start_index, unique=distinct[0])
+    if index_kind == nn_index.BKTreeIndex.kind:
+        return nn_index.BKTreeIndex.from_flat(build_tree(haplotypes,start_index,end_index,tree_dir))
+    nn = nn_index.INDEX_KINDS[index_kind](end_index-start_index)
+    nn.insert_all(haplotypes, np.arange(len(haplotypes)) // 2, distinct)
+    return nn
+
+def warm_start_bounds(haplotypes,query_indices,skips,hints):
+    """
+    Upper bounds on the nearest distances of the query haplotypes from their hints, the individuals that were the
+    best matches of the same haplotype in the previous window (see next_hints()): the distance to the closest
+    haplotype of a hint that is not skipped, or 2**32 without one. Returns the bounds and the number of distances
+    computed for each query
+    """
+    bounds = np.full(len(query_indices), 2**32, dtype=np.int64)
+    evals = np.zeros(len(query_indices), dtype=np.int64)
+    for q,(i,skip) in enumerate(zip(query_indices,skips)):
+        rows = [row for individual in hints.get(i,()) if individual not in skip
+                for row in (2*individual, 2*individual+1)]
+        if rows:
+            bounds[q] = BKTree.popcount_distances(haplotypes[rows],haplotypes[i]).min()
+            evals[q] = len(rows)
+    return bounds, evals
+
+def next_hints(nn,query_indices,skips,lookups,max_hints=4):
+    """
+    Returns the hints for the next window: for each query haplotype, up to max_hints of the (not skipped)
+    individuals in its nearest neighbours in this window
+    """
+    hints = {}
+    for i,skip,(results,_,_) in zip(query_indices,skips,lookups):
+        individuals = []
+        for node in results:
+            for individual in nn.node_elements(node):
+                if individual not in skip and individual not in individuals:
+                    individuals.append(individual)
+                    if len(individuals) == max_hints:
+                        break
+            if len(individuals) == max_hints:
+                break
+        hints[i] = individuals
+    return hints
+
+def match(haplotypes,start_index,end_index,samples,relatives,trios,child_find,index,tree_dir=None,output_format="columnar",profile=None,index_kind="auto",all_samples=False,max_distance=None,max_visits=None,part=0,num_parts=1,hints=None,chunk_size=4096):
+    """
+    Find the nearest neighbours of the window's trio haplotypes (every haplotype with all_samples, or the part'th
+    of num_parts shares of them) in chunks of chunk_size, and write them to the window's collated file. With
+    hints, BK tree lookups are warm-started and the hints for the next window are returned. profile, if given,
+    gets the stage timings and lookup counters
+    """
+    # samples = ukbiobank_header.txt (all sample names of individuals in biobank data), relatives = dictionary
+    # {sample name: close relative sample names to skip when querying the key}, trios = set of all the trios indices
+    # in the igd, child_find = dictionary {trio sample names: associated child sample name(s) in a list}; if trio
+    # sample is a child then key = value. These are only loaded once per process
+    reference = reference_data.get_reference(samples,relatives,trios,child_find)
+    samp_names = reference.samp_names
+
+    window_len = end_index-start_index
     start_time = time.time()
+    nn = build_index(haplotypes,start_index,end_index,tree_dir,index_kind)
+    tree_time = time.time()
+
+    if all_samples:
+        query_indices = np.arange(len(haplotypes), dtype=np.int64)
+    else:
+        query_indices = np.array([i for i in range(len(haplotypes)) if (i // 2) in reference.trio_set], dtype=np.int64)
+    if num_parts > 1:
+        query_indices = np.array_split(query_indices, num_parts)[part]
+    num_queries = len(query_indices)
+    stats = BKTree.LookupStats.zeros(num_queries) if profile is not None else None
+    warm_start_evals = np.zeros(num_queries, dtype=np.int64)
+    complete = np.ones(num_queries, dtype=bool)
+    dist_best = np.zeros(num_queries, dtype=np.int64)
+    next_window_hints = {} if hints is not None else None
+    lookup_seconds = collate_seconds = 0.0
+
+    name = collated_name(index,part,num_parts)
+    matches = []
+    writer = None
+    if output_format == "columnar":
+        writer = columnar.ColumnarWriter(f"{name}.col",start_index,end_index,window_len,nn.vectors)
+    with writer if writer is not None else contextlib.nullcontext():
+        for chunk_start in range(0, num_queries, chunk_size):
+            chunk_time = time.time()
+            chunk = slice(chunk_start, chunk_start+chunk_size)
+            hap_indices = query_indices[chunk]
+            skips = [reference.relatives(i // 2) for i in hap_indices.tolist()]
+            bounds = None
+            if hints is not None and nn.kind == nn_index.BKTreeIndex.kind:
+                bounds, warm_start_evals[chunk] = warm_start_bounds(haplotypes,hap_indices.tolist(),skips,hints)
+            lookups, complete[chunk] = nn.lookup_batch(haplotypes[hap_indices], skips,
+                                                       stats[chunk] if stats is not None else None,
+                                                       bounds, max_distance, max_visits)
+            if next_window_hints is not None:
+                next_window_hints.update(next_hints(nn,hap_indices.tolist(),skips,lookups))
+            dist_best[chunk] = [d for _, d, _ in lookups]
+            lookup_time = time.time()
+            lookup_seconds += lookup_time-chunk_time
+
+            if writer is not None:
+                write_columnar_rows(writer,haplotypes,nn,hap_indices,lookups,reference,start_index,end_index,complete[chunk])
+            else:
+                for i,(results, d, exact_matches),is_complete in zip(hap_indices.tolist(), lookups, complete[chunk].tolist()):
+                    matches.append({\
+                            'start_index':start_index,\
+                            'end_index':end_index,\
+                            'query':''.join([str(x) for x in BKTree.unpack_vector(haplotypes[i], window_len)]),\
+                            'matches':[BKTree.unpack_vector(nn.vectors[x], window_len) for x in results],\
+                            'edit_distance':d, \
+                            'exact_matches':[BKTree.unpack_vector(nn.vectors[x], window_len) for x in exact_matches],\
+                            'hap_index': i,\
+                            'sample_name':samp_names[i//2],\
+                            'child_name(s)': reference.child_finder.get(samp_names[i//2], []),\
+                            'complete': is_complete\
+                            })
+            collate_seconds += time.time()-lookup_time
+    if writer is None:
+        collate_time = time.time()
+        collate(matches,name)
+        collate_seconds += time.time()-collate_time
+
+    if profile is not None:
+        profile['tree_build_seconds'] = tree_time-start_time
+        profile['lookup_seconds'] = lookup_seconds
+        profile['collate_seconds'] = collate_seconds
+        profile['index'] = nn.kind
+        profile['unique_vectors'] = nn.num_nodes
+        profile['tree_depth'] = nn.depth if nn.kind == nn_index.BKTreeIndex.kind else None
+        profile['queries'] = num_queries
+        profile['incomplete_lookups'] = int(num_queries - complete.sum())
+        counters = {'nodes_visited': stats.nodes_visited, 'distance_evals': stats.distance_evals,
+                    'pruned_subtrees': stats.pruned_subtrees, 'warm_start_evals': warm_start_evals,
+                    'dist_best': dist_best}
+        if all_samples:
+            profile['lookup_summary'] = {counter: profile_report.counter_summary(values)
+                                         for counter,values in counters.items()}
+        else:
+            profile['lookups'] = {'hap_index': query_indices.tolist(),
+                                  **{counter: values.tolist() for counter,values in counters.items()}}
+    return next_window_hints
+
+def load_window(igd,start_index,end_index):
+    """
+    Read the variants start_index...end_index-1 into a (num_samples x ceil(window_len/64)) matrix of packed
+    haplotypes (see BKTree.pack_matrix), setting each variant's bit for all of its samples in one scatter write
+    """
+    window_len = end_index-start_index
+    haplotypes = np.zeros((igd.num_samples, (window_len+63)//64), dtype=np.uint64)
+    for i in range(window_len): #it is important not to read the end marker itself to avoid overlaps
+        samples = np.asarray(igd.get_samples(i+start_index)[2], dtype=np.int64)
+        haplotypes[samples, i//64] |= np.uint64(1 << (i%64))
+    return haplotypes
+
+def proc_status_mb(field):
+    """
+    A memory size field of /proc/self/status (e.g. VmRSS, VmHWM) in MB, or None where there is no such file
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process to its current RSS, so that peak_rss_mb() covers only what
+    follows (e.g. one window, on a worker that runs many). Returns False where that is not supported
+    """
+    try:
+        with open("/proc/self/clear_refs","w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process since the last reset_peak_rss() (or its start), in MB
+    """
+    peak = proc_status_mb("VmHWM")
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def window_rss(per_window_peak,start_rss):
+    """
+    The peak_rss_mb and window_rss_mb of a window's profile record (see window()), given whether reset_peak_rss()
+    worked at its start and the RSS it started at
+    """
+    peak = peak_rss_mb() if per_window_peak else None
+    return {'peak_rss_mb': peak,
+            'window_rss_mb': peak - start_rss if peak is not None and start_rss is not None else None}
+
+def append_jsonl(filename,record):
+    """
+    Append a record as one line of a JSON-lines file. The line is written with a single write() to a file opened
+    for appending, so that the lines of concurrent windows do not interleave
+    """
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record) + "\n").encode())
+    finally:
+        os.close(fd)
+
+def window(igd_file,start_index,end_index,samples, relatives,trios,child_find,index,tree_dir=None,output_format="columnar",profile_file=None,index_kind="auto",all_samples=False,max_distance=None,max_visits=None,part=0,num_parts=1,hints=None):
+    """
+    Parse a window's packed haplotypes and match them (see match()), appending its profile record, with the
+    window's own peak RSS, to profile_file if given. Returns the hints for the next window
+    """
+    start_time = time.time()
+    per_window_peak = reset_peak_rss()
+    start_rss = proc_status_mb("VmRSS")
     print(f"starting window {index}",flush=True)
 
     with pyigd.IGDFile(igd_file) as igd:
-        haplotypes=[[0 for _ in range(end_index-start_index)] for _ in range(igd.num_samples)]
+        haplotypes = load_window(igd,start_index,end_index)
+    parse_time = time.time()
+    print(f"window {index}: parsed {haplotypes.shape[0]} haplotypes in {parse_time-start_time} seconds, "
+          f"haplotype matrix {haplotypes.nbytes/2**20:.1f} MB, peak RSS {peak_rss_mb():.1f} MB",flush=True)
 
-        for i in range(end_index-start_index): #it is important not to read the end marker itself to avoid overlaps
-            for variant in igd.get_samples(i+start_index)[2]:
-                haplotypes[variant][i] = 1
-
-    match(haplotypes,start_index,end_index,samples,relatives,trios,child_find,index)
+    profile = None
+    if profile_file is not None:
+        profile = {'window': index, 'part': part, 'num_parts': num_parts, 'start_index': start_index,
+                   'end_index': end_index, 'haplotypes': haplotypes.shape[0], 'parse_seconds': parse_time-start_time}
+    hints = match(haplotypes,start_index,end_index,samples,relatives,trios,child_find,index,tree_dir,output_format,profile,index_kind,all_samples,max_distance,max_visits,part,num_parts,hints)
     end_time=time.time()
-    print(f"time to parse igd and match a window {index}: {(end_time)-(start_time)} seconds",flush=True)
+    print(f"time to parse igd and match a window {index}: {(end_time)-(start_time)} seconds, "
+          f"peak RSS {peak_rss_mb():.1f} MB",flush=True)
+    if profile is not None:
+        profile['total_seconds'] = end_time-start_time
+        profile.update(window_rss(per_window_peak,start_rss))
+        append_jsonl(profile_file, profile)
+    return hints
+
+def read_positions(igd_file):
+    """
+    Returns the base-pair positions of all variants as an array. The variant index is read in a single bulk read,
+    and if the first and last positions disagree with get_position_and_flags() the positions are read one variant
+    at a time instead
+    """
+    with pyigd.IGDFile(igd_file) as igd:
+        num_variants = igd.num_variants
+        if num_variants == 0:
+            return np.zeros(0, dtype=np.int64)
+        first, last = igd.get_position_and_flags(0)[0], igd.get_position_and_flags(num_variants-1)[0]
+        with open(igd_file, "rb") as f:
+            header = pyigd.IGDHeader(*struct.unpack(pyigd.IGDConstants.HEADER_FORMAT,
+                                                    f.read(pyigd.IGDConstants.NUM_HEADER_BYTES))[:12])
+            f.seek(header.fp_index)
+            index = np.frombuffer(f.read(num_variants*pyigd.IGDConstants.INDEX_ENTRY_BYTES), dtype="<u8")
+        if len(index) == num_variants*pyigd.IGDConstants.INDEX_ENTRY_BYTES//8:
+            position_mask = np.uint64(pyigd.readwrite.BP_POS_ONLY_MASK & (2**64-1))
+            positions = (index[::pyigd.IGDConstants.INDEX_ENTRY_BYTES//8] & position_mask).astype(np.int64)
+            if positions[0] == first and positions[-1] == last:
+                return positions
+        return np.array([igd.get_position_and_flags(i)[0] for i in range(num_variants)], dtype=np.int64)
+
+def window_boundaries(positions,window_size):
+    """
+    Returns the variant indices at which new windows start: a new window starts at the first variant that is at
+    least window_size base pairs after the start of the previous one (the first window starts at variant 0, and
+    the last boundary is at most the last variant)
+    """
+    boundaries = []
+    counter = window_size+positions[0]
+    next_index = 2
+    while True:
+        next_index = max(next_index, int(np.searchsorted(positions, counter, side="left")))
+        if next_index > len(positions)-1:
+            return boundaries
+        boundaries.append(next_index)
+        counter = positions[next_index]+window_size
+        next_index += 1
+
+def get_window_positions(igd_file,window_size):
+    """
+    Returns the list [0, b1, b1, b2, b2, ...] of window boundaries, which get_input() pairs into windows. The
+    boundaries are cached in a sidecar file next to the igd file, which is reused while the igd file's path,
+    modification time and the window size are unchanged
+    """
+    cache_file = f"{igd_file}.windows_{window_size}.json"
+    key = {'igd_file': os.path.abspath(igd_file), 'mtime': os.path.getmtime(igd_file), 'window_size': window_size}
+    if os.path.exists(cache_file):
+        with open(cache_file) as c:
+            cached = json.load(c)
+        if cached.get('key') == key:
+            return cached['df_positions']
 
-def get_input(igd_file,window_size,samples,relatives,trios,child_find):
+    positions = read_positions(igd_file)
+    df_positions = [0]
+    for boundary in window_boundaries(positions,window_size):
+        df_positions.append(boundary)
+        df_positions.append(boundary)
+
+    try:
+        with atomic_write(cache_file) as temp_file, open(temp_file,"w") as c:
+            json.dump({'key': key, 'df_positions': df_positions}, c)
+    except OSError:
+        pass # the igd file's directory is not writable, so just don't cache
+    return df_positions
+
+class WindowArgs(NamedTuple):
     """
-    Returns iterable used for starmap()
+    The arguments of window() for one window, as made by get_input()
     """
+    igd_file: str
+    start_index: int
+    end_index: int
+    samples: str
+    relatives: str
+    trios: str
+    child_find: str
+    index: int
+    tree_dir: Optional[str] = None
+    output_format: str = "columnar"
+    profile_file: Optional[str] = None
+    index_kind: str = "auto"
+    all_samples: bool = False
+    max_distance: Optional[int] = None
+    max_visits: Optional[int] = None
 
-    with pyigd.IGDFile(igd_file) as f:
-      df_positions = [0]
+def get_input(igd_file,window_size,samples,relatives,trios,child_find,tree_dir=None,output_format="columnar",profile_file=None,index_kind="auto",all_samples=False,max_distance=None,max_visits=None):
+    """
+    Returns the WindowArgs of every window
+    """
 
-      counter = window_size+f.get_position_and_flags(0)[0]
-      for i in range(1,f.num_variants-1):
-          if (f.get_position_and_flags(i+1)[0] < counter):
-              continue
-          else:
-              df_positions.append(i+1)
-              df_positions.append(i+1)
-              counter = f.get_position_and_flags(i+1)[0]+window_size
-            
+    df_positions = get_window_positions(igd_file,window_size)
 
     num_windows = len(df_positions)
     positions_iter = iter(df_positions)
@@ -146,14 +528,277 @@ def get_input(igd_file,window_size,samples,relatives,trios,child_find):
     trios_files = [trios for _ in range(num_windows)]
     child_find_files = [child_find for _ in range(num_windows)]
     index = list(range(num_windows))
+    tree_dirs = [tree_dir for _ in range(num_windows)]
+    output_formats = [output_format for _ in range(num_windows)]
+    profile_files = [profile_file for _ in range(num_windows)]
+    index_kinds = [index_kind for _ in range(num_windows)]
+    all_samples_flags = [all_samples for _ in range(num_windows)]
+    max_distances = [max_distance for _ in range(num_windows)]
+    max_visits_list = [max_visits for _ in range(num_windows)]
 
-    return zip(igd_files,positions_iter,positions_iter,samples_files,relatives_files,trios_files,child_find_files,index)
+    return map(WindowArgs._make, zip(igd_files,positions_iter,positions_iter,samples_files,relatives_files,trios_files,child_find_files,index,tree_dirs,output_formats,profile_files,index_kinds,all_samples_flags,max_distances,max_visits_list))
 
-def multipool(input):
-    number_of_cores = 64
-    with multiprocessing.Pool(number_of_cores) as pool:
-        # distribute computations and collect results:
-        pool.starmap(window, input)
+def window_cost(start_index,end_index,num_haplotypes,num_queries,num_parts=1):
+    """
+    Estimated relative cost of a window (or of one of its num_parts parts): building the index is linear in the
+    number of variants times the number of haplotypes, and the lookups in the number of variants times the number
+    of query (trio) haplotypes, which are shared between the parts. Every part builds the index again unless it
+    memory-maps a tree built before (num_haplotypes=0 gives the cost of the lookups alone)
+    """
+    return (end_index-start_index)*(num_haplotypes+num_queries/num_parts)
+
+def query_counts(reference_files,all_samples=False):
+    """
+    The number of haplotypes and of query haplotypes per window in the cost model (see window_cost()), from the
+    (samples, relatives, trios, child_find) reference files
+    """
+    reference = reference_data.get_reference(*reference_files)
+    num_haplotypes = 2*len(reference.samp_names)
+    return num_haplotypes, num_haplotypes if all_samples else 2*len(reference.trio_set)
+
+def shard_windows(windows,num_shards,num_haplotypes=1,num_queries=1):
+    """
+    Partition the windows between num_shards shards (e.g. machines) with balanced estimated costs: each window,
+    most expensive first, goes to the shard with the lowest total so far. The assignment only depends on the
+    window table and the cost model, so every shard computes the same one. Returns the windows of every shard, in
+    window order
+    """
+    costs = [window_cost(w.start_index,w.end_index,num_haplotypes,num_queries) for w in windows]
+    loads = [(0.0, shard) for shard in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    for k in sorted(range(len(windows)), key=lambda k: (-costs[k], k)):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(k)
+        heapq.heappush(loads, (load+costs[k], shard))
+    return [[windows[k] for k in sorted(shard)] for shard in shards]
+
+def plan_tasks(input,workers,num_haplotypes=1,num_queries=1,split=True,warm_start=False,tree_dir=None):
+    """
+    Returns the tasks (windows, part, num_parts, estimated cost) for all the windows, most expensive first, where
+    windows are the arguments of the windows that the task runs in order, and the tasks to run once others are
+    done, as a map from window index to tasks.
+
+    With split, a window that costs more than an even share of the total among the workers is split into parts
+    that each look up a contiguous subset of its queries. When every part has many more queries than there are
+    haplotypes, each part simply builds the index itself. Otherwise rebuilding it would cost about as much as the
+    whole window, so if the window may get a BK tree, a first task (with part None) builds it into the window's
+    tree_dir (or tree_dir if it has none) and the parts, which only run after it, memory-map it (see
+    build_window_index()); multi-index hashing windows are not split then. With warm_start, tasks are instead runs
+    of consecutive windows (two per worker), so that each window can be warm-started from the one before it
+    """
+    windows = list(input)
+    if not windows:
+        return [], {}
+    costs = [window_cost(w.start_index,w.end_index,num_haplotypes,num_queries) for w in windows]
+    tasks = []
+    deferred = {}
+    if warm_start:
+        for run in np.array_split(np.arange(len(windows)), min(len(windows), 2*workers)):
+            tasks.append(([windows[i] for i in run.tolist()], 0, 1, sum(costs[i] for i in run.tolist())))
+    else:
+        share = sum(costs)/workers
+        for w,cost in zip(windows,costs):
+            num_parts = 1
+            if split and share > 0 and cost > share:
+                num_parts = max(1, min(int(np.ceil(cost/share)), num_queries))
+            shares_tree = (w.index_kind != nn_index.MultiIndexHashing.kind
+                           and (w.tree_dir or tree_dir) is not None)
+            if num_parts > 1 and num_queries/num_parts < num_haplotypes and shares_tree:
+                # Only the lookups are split, so only they need to exceed a share
+                lookup_cost = window_cost(w.start_index,w.end_index,0,num_queries)
+                num_parts = max(1, min(int(np.ceil(lookup_cost/share)), num_queries))
+                if num_parts > 1:
+                    shared = w._replace(tree_dir=w.tree_dir or tree_dir)
+                    tasks.append(([shared], None, num_parts, window_cost(w.start_index,w.end_index,num_haplotypes,0)))
+                    deferred[w.index] = [([shared], part, num_parts,
+                                          window_cost(w.start_index,w.end_index,0,num_queries,num_parts))
+                                         for part in range(num_parts)]
+                    continue
+            elif num_parts > 1 and num_queries/num_parts < num_haplotypes:
+                num_parts = 1
+            for part in range(num_parts):
+                tasks.append(([w], part, num_parts,
+                              window_cost(w.start_index,w.end_index,num_haplotypes,num_queries,num_parts)))
+    tasks.sort(key=lambda task: -task[3])
+    return tasks, deferred
+
+def build_window_index(args,num_parts):
+    """
+    Build the BK tree of a window split into num_parts into its tree_dir, appending a profile record (with part
+    None) if it has a profile file. Returns the window's index kind; if auto picks multi-index hashing, nothing
+    is built
+    """
+    start_time = time.time()
+    per_window_peak = reset_peak_rss()
+    start_rss = proc_status_mb("VmRSS")
+    with pyigd.IGDFile(args.igd_file) as igd:
+        haplotypes = load_window(igd,args.start_index,args.end_index)
+    parse_time = time.time()
+    index_kind = args.index_kind
+    if index_kind == "auto":
+        index_kind = nn_index.choose_index(haplotypes, args.end_index-args.start_index)
+    if index_kind != nn_index.BKTreeIndex.kind:
+        return index_kind
+    tree = build_tree(haplotypes,args.start_index,args.end_index,args.tree_dir)
+    end_time = time.time()
+    print(f"window {args.index}: built its BK tree for {num_parts} parts in {end_time-parse_time:.2f} seconds",
+          flush=True)
+    if args.profile_file is not None:
+        profile = {'window': args.index, 'part': None, 'num_parts': num_parts, 'start_index': args.start_index,
+                   'end_index': args.end_index, 'haplotypes': haplotypes.shape[0],
+                   'parse_seconds': parse_time-start_time, 'tree_build_seconds': end_time-parse_time,
+                   'index': index_kind, 'unique_vectors': len(tree.vectors),
+                   'tree_depth': BKTree.flat_bk_tree_depth(tree),
+                   'total_seconds': end_time-start_time}
+        profile.update(window_rss(per_window_peak,start_rss))
+        append_jsonl(args.profile_file, profile)
+    return index_kind
+
+def run_task(task,warm_start=False):
+    """
+    Run one task from plan_tasks(), warm-starting each of its windows from the one before it if warm_start is
+    set, and return its timing record. A task that was to build the tree of a split window runs the whole
+    window instead if the window gets multi-index hashing, and records index_built False
+    """
+    windows, part, num_parts, cost = task
+    start_time = time.time()
+    timing = {}
+    if part is None:
+        args = windows[0]
+        index_kind = build_window_index(args,num_parts)
+        timing['index_built'] = index_kind == nn_index.BKTreeIndex.kind
+        if not timing['index_built']:
+            part, num_parts = 0, 1
+            window(*args._replace(index_kind=index_kind))
+    else:
+        hints = {} if warm_start else None
+        for args in windows:
+            hints = window(*args, part=part, num_parts=num_parts, hints=hints)
+    timing.update({'windows': [args.index for args in windows], 'part': part, 'num_parts': num_parts,
+                   'variants': sum(args.end_index-args.start_index for args in windows), 'cost': cost,
+                   'seconds': time.time()-start_time, 'pid': os.getpid()})
+    return timing
+
+def merge_parts(index,num_parts,output_format):
+    """
+    Join the files of the parts of a split window into the window's own collated file, and remove them
+    """
+    parts = [collated_name(index,part,num_parts) for part in range(num_parts)]
+    if output_format == "columnar":
+        columnar.merge_columnar([f"{name}.col" for name in parts], f"{collated_name(index)}.col")
+        extension = "col"
+    else:
+        results = []
+        for name in parts:
+            with open(f"{name}.pkl","rb") as f:
+                results.append(pickle.load(f))
+        write(pd.concat(results, ignore_index=True), collated_name(index))
+        extension = "pkl"
+    for name in parts:
+        os.remove(f"{name}.{extension}")
+
+def resume_windows(windows,run_manifest,previous):
+    """
+    Returns the windows that still have to be run, given the manifest of a previous run in the same directory.
+    The windows that it records as finished with the same content key and an unchanged output are skipped, and
+    their entries carried over to run_manifest
+    """
+    # Check the previous entries against the keys of the current inputs
+    previous = dict(previous, inputs=run_manifest["inputs"])
+    pending = []
+    for w in windows:
+        index, start_index, end_index = w.index, w.start_index, w.end_index
+        if manifest.is_finished(previous,index,start_index,end_index,output_file(index,w.output_format)):
+            run_manifest["windows"][str(index)] = previous["windows"][str(index)]
+        else:
+            pending.append(w)
+    return pending
+
+def multipool(input,reference_files=(),workers=None,split=True,task_log=None,run_manifest=None,manifest_file=None,warm_start=False):
+    """
+    Run all the windows on a pool of workers (all the cores by default). reference_files are the (samples,
+    relatives, trios, child_find) files, which are loaded once here and shared with the workers instead of being
+    reloaded for every window; they also give the haplotype and trio counts of the cost model (see plan_tasks()).
+    Tasks are dispatched most expensive first, and the timing of every task is printed and, if task_log is
+    given, appended to it as JSON lines. Every window that is finished is recorded in run_manifest, which is
+    rewritten to manifest_file. With warm_start, each task runs consecutive windows in order and warm-starts
+    their lookups (see match()). The trees that split windows share are built in a temporary directory here,
+    unless the windows have a tree_dir
+    """
+    workers = workers if workers is not None else os.cpu_count()
+    input = list(input)
+    if not input:
+        # e.g. a resumed run with every window finished, or a shard with no windows
+        print("no windows to run",flush=True)
+        return
+    num_haplotypes = num_queries = 1
+    if reference_files:
+        num_haplotypes, num_queries = query_counts(reference_files,any(w.all_samples for w in input))
+    tree_dir = tempfile.mkdtemp(prefix="trees_", dir=".") if split and not warm_start else None
+    tasks, deferred = plan_tasks(input,workers,num_haplotypes,num_queries,split,warm_start,tree_dir)
+    parts_left = {w.index: task[2] for task in tasks + [t for d in deferred.values() for t in d]
+                  if task[1] is not None for w in task[0]}
+    windows = {w.index: w for task in tasks for w in task[0]}
+
+    start_time = time.time()
+    seconds_per_cost = []
+    try:
+        with multiprocessing.Pool(workers, initializer=reference_data.get_reference if reference_files else None,
+                                  initargs=tuple(reference_files)) as pool:
+            run_pool(pool,tasks,deferred,warm_start,parts_left,windows,task_log,run_manifest,manifest_file,
+                     seconds_per_cost)
+    finally:
+        if tree_dir is not None:
+            shutil.rmtree(tree_dir, ignore_errors=True)
+    if seconds_per_cost:
+        print(f"{len(tasks)+sum(len(d) for d in deferred.values())} tasks on {workers} workers in "
+              f"{time.time()-start_time:.1f} seconds; seconds per unit of estimated cost: median "
+              f"{np.median(seconds_per_cost):.3g}, min {np.min(seconds_per_cost):.3g}, "
+              f"max {np.max(seconds_per_cost):.3g}",flush=True)
+
+def run_pool(pool,tasks,deferred,warm_start,parts_left,windows,task_log,run_manifest,manifest_file,seconds_per_cost):
+    """
+    The dispatch loop of multipool(): submits the tasks in order, and the deferred tasks of a window once the task
+    that builds its index is done, then handles every finished task
+    """
+    finished = queue.Queue()
+    def submit(task):
+        pool.apply_async(run_task, (task, warm_start), callback=finished.put, error_callback=finished.put)
+    for task in tasks:
+        submit(task)
+    pending = len(tasks)
+    while pending:
+        timing = finished.get()
+        pending -= 1
+        if isinstance(timing, BaseException):
+            raise timing
+        indices, num_parts = timing['windows'], timing['num_parts']
+        names = f"window {indices[0]}" if len(indices) == 1 else f"windows {indices[0]}-{indices[-1]}"
+        step = "index build" if timing.get('index_built') else f"part {timing['part']+1}/{num_parts}"
+        print(f"task {names} {step}: estimated cost {timing['cost']:.3g}, {timing['seconds']:.2f} seconds",flush=True)
+        if task_log is not None:
+            append_jsonl(task_log, timing)
+        if timing['cost'] > 0:
+            seconds_per_cost.append(timing['seconds']/timing['cost'])
+        if timing.get('index_built'):
+            for task in deferred[indices[0]]:
+                submit(task)
+            pending += len(deferred[indices[0]])
+            continue
+        if timing.get('index_built') is False:
+            # The window got multi-index hashing, so its build task ran all of it
+            parts_left[indices[0]] = 1
+        for index in indices:
+            parts_left[index] -= 1
+            if parts_left[index] > 0:
+                continue
+            w = windows[index]
+            if num_parts > 1:
+                merge_parts(index,num_parts,w.output_format)
+            if run_manifest is not None:
+                manifest.record_window(run_manifest,index,w.start_index,w.end_index,output_file(index,w.output_format))
+        if run_manifest is not None:
+            manifest.write_manifest(run_manifest,manifest_file)
 
 
 def main():
@@ -161,12 +806,64 @@ def main():
     parser.add_argument('-w', '--window_size', type=int, required=True, help="window size to run matching with")
     parser.add_argument('-i', '--igd_file', required=True, help="igd file of data")
     parser.add_argument('-s','--samples',required=True,help="txt file with a list of all sample names in the igd file")
-    parser.add_argument('-r','--relatives',required=True,help="pickle file of dictionary with keys as samples, values as the close relatives to skip when querying the key")
+    parser.add_argument('-r','--relatives',required=True,help="pickle file of dictionary with keys as samples, values as the close relatives to skip when querying the key, or its compact .npz version from reference_data.py")
     parser.add_argument('-t','--trios',required=True,help="pickle file with a set of all the trios indices in the igd")
     parser.add_argument('-d','--child_find',required=True,help="pickle file of dictionary where keys are trio samples and values are the associated child")
+    parser.add_argument('--tree_dir',default=None,help="directory for saving each window's BK tree, so that reruns on the same igd file memory-map the trees instead of rebuilding them")
+    parser.add_argument('-f','--output_format',choices=["columnar","pickle"],default="columnar",help="write each window's results as a compact columnar collated_{index}.col file, or as a pickled DataFrame collated_{index}.pkl")
+    parser.add_argument('-p','--profile',default=None,help="JSON-lines file to append a profile record to for every window (stage timings, peak RSS, tree size and depth, per-lookup BK tree counters); see profile_report.py")
+    parser.add_argument('--index',choices=["auto"]+sorted(nn_index.INDEX_KINDS),default="auto",help="nearest-neighbour index used in each window: a BK tree, multi-index hashing (mih, faster when nearest neighbours are many mismatches apart), or auto to pick one per window")
+    parser.add_argument('--workers',type=int,default=None,help="number of worker processes (default: all the cores)")
+    parser.add_argument('--no_split',action='store_true',help="never split an expensive window into tasks over subsets of its queries")
+    parser.add_argument('--task_log',default=None,help="JSON-lines file to append every task's estimated cost and timing to, for tuning the cost model")
+    parser.add_argument('--manifest',default="manifest.json",help="manifest of the run, recording its inputs (igd file, window size, digests of the reference files) and every finished window")
+    parser.add_argument('--resume',action='store_true',help="skip the windows that the manifest of a previous run records as finished with the same inputs and an unchanged output")
+    parser.add_argument('--warm_start',action='store_true',help="run consecutive windows in order on each worker, starting every lookup from the distance to the query's best matches in the previous window; the results are the same, with fewer distance evaluations (compare profiles with profile_report.py --baseline)")
+    parser.add_argument('--all_samples',action='store_true',help="look up the nearest neighbours of every haplotype instead of only the trio haplotypes (needs the columnar output format)")
+    parser.add_argument('--max_distance',type=int,default=None,help="only return neighbours within this many mismatches; a haplotype without any gets no matches")
+    parser.add_argument('--max_visits',type=int,default=None,help="budget of BK tree nodes visited per lookup; a lookup that runs out returns the best neighbours found so far and is marked as not complete")
+    parser.add_argument('--shard',default=None,help="run only shard i of N (given as i/N, counting from 0) of the windows, for spreading a run over machines that share a filesystem; windows are assigned to shards by estimated cost, and each shard writes to its own output directory (merge them with collate_results.py --shards)")
+    parser.add_argument('-o','--output_dir',default=None,help="directory to write the collated files, manifest, profile and task log to (default: the current directory, or shard_<i>_of_<N> with --shard)")
     args = parser.parse_args()
+    if args.all_samples and args.output_format != "columnar":
+        parser.error("--all_samples needs the columnar output format")
+    shard = None
+    if args.shard is not None:
+        try:
+            shard = tuple(int(x) for x in args.shard.split("/"))
+        except ValueError:
+            shard = ()
+        if len(shard) != 2 or not 0 <= shard[0] < shard[1]:
+            parser.error(f"--shard must be i/N with 0 <= i < N, not {args.shard}")
+
+    # Inputs are opened by absolute path, as the run writes from (and to) the output directory
+    reference_files = tuple(os.path.abspath(f) for f in (args.samples,args.relatives,args.trios,args.child_find))
+    igd_file = os.path.abspath(args.igd_file)
+    tree_dir = os.path.abspath(args.tree_dir) if args.tree_dir is not None else None
+    query_options = {"all_samples": args.all_samples, "max_distance": args.max_distance, "max_visits": args.max_visits}
+    windows = list(get_input(igd_file,args.window_size,*reference_files,tree_dir,args.output_format,args.profile,args.index,**query_options))
+    num_windows = len(windows)
+    if shard is not None:
+        windows = shard_windows(windows,shard[1],*query_counts(reference_files,args.all_samples))[shard[0]]
+        print(f"shard {shard[0]}/{shard[1]}: {len(windows)} of {num_windows} windows",flush=True)
+    output_dir = args.output_dir
+    if output_dir is None and shard is not None:
+        output_dir = f"shard_{shard[0]}_of_{shard[1]}"
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        os.chdir(output_dir)
 
-    multipool(get_input(args.igd_file,args.window_size,args.samples,args.relatives,args.trios,args.child_find))
+    run_manifest = manifest.new_manifest(manifest.run_inputs(igd_file,args.window_size,reference_files,args.output_format,args.index,query_options))
+    run_manifest["num_windows"] = num_windows
+    run_manifest["shard"] = {"shard": shard[0] if shard else 0, "num_shards": shard[1] if shard else 1,
+                             "windows": [w.index for w in windows]}
+    previous = manifest.read_manifest(args.manifest) if args.resume else None
+    if previous is not None:
+        num_shard_windows = len(windows)
+        windows = resume_windows(windows,run_manifest,previous)
+        print(f"resuming: {num_shard_windows-len(windows)} of {num_shard_windows} windows are already finished",flush=True)
+    manifest.write_manifest(run_manifest,args.manifest)
+    multipool(windows,reference_files,args.workers,not args.no_split,args.task_log,run_manifest,args.manifest,args.warm_start)
 
 if __name__ == "__main__":
     main()
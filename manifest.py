@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+from atomic_file import atomic_write
+
+MANIFEST_VERSION = 2
+# The format of a window's collated file; bump it when the output of a window changes for the same inputs, so
+# that resumed runs redo every window
+OUTPUT_VERSION = 2
+
+def file_digest(filename,block_size=1<<20):
+    """
+    Returns the SHA-256 hex digest of the contents of filename
+    """
+    digest = hashlib.sha256()
+    with open(filename,"rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def file_fingerprint(filename,block_size=1<<20,num_samples=64):
+    """
+    Returns a cheap stand-in for the digest of a large file: the SHA-256 hex digest of its size, its first and
+    last block_size bytes (for an igd file, its header and the tables at its end) and num_samples evenly spaced
+    blocks of block_size/16 bytes in between. It does not depend on the file's path or modification time, so a
+    copy of the file on another machine has the same fingerprint
+    """
+    size = os.path.getsize(filename)
+    digest = hashlib.sha256(str(size).encode())
+    blocks = ([(0, block_size)] + [(size * (i+1) // (num_samples+1), block_size >> 4) for i in range(num_samples)]
+              + [(max(0, size - block_size), block_size)])
+    with open(filename,"rb") as f:
+        for offset,length in blocks:
+            f.seek(offset)
+            digest.update(f.read(length))
+    return digest.hexdigest()
+
+def run_inputs(igd_file,window_size,reference_files,output_format,index_kind,query_options=None):
+    """
+    Returns the description of a find_errors.py run that goes into its manifest: the igd file, window size and
+    options (query_options being those that choose and bound the lookups), the path and file_fingerprint() of the
+    igd file, which is too large to read in full on every run, and the path and SHA-256 digest of each reference
+    file (samples, relatives, trios, child_find)
+    """
+    names = ["samples","relatives","trios","child_find"]
+    return {"igd_file": igd_file, "igd_fingerprint": file_fingerprint(igd_file), "window_size": int(window_size),
+            "output_format": output_format, "index_kind": index_kind, "output_version": OUTPUT_VERSION,
+            "query_options": dict(query_options or {}),
+            "reference": {name: {"file": filename, "sha256": file_digest(filename)}
+                          for name,filename in zip(names,reference_files)}}
+
+def window_key(inputs,start_index,end_index):
+    """
+    The content key of a window: a digest of everything its collated file depends on. File paths and the window
+    size are left out, so moving the inputs or changing the window size only reruns the windows whose contents
+    change
+    """
+    key = {"igd_fingerprint": inputs["igd_fingerprint"], "output_format": inputs["output_format"],
+           "index_kind": inputs["index_kind"], "output_version": inputs["output_version"],
+           "query_options": inputs["query_options"],
+           "reference": {name: reference["sha256"] for name,reference in inputs["reference"].items()},
+           "start_index": int(start_index), "end_index": int(end_index)}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def new_manifest(inputs):
+    return {"version": MANIFEST_VERSION, "inputs": inputs, "windows": {}}
+
+def read_manifest(filename):
+    """
+    Returns the manifest in filename, or None if there is none (or it is from another version)
+    """
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        manifest = json.load(f)
+    return manifest if manifest.get("version") == MANIFEST_VERSION else None
+
+def write_manifest(manifest,filename):
+    """
+    Write the manifest under a temporary name and rename it, so that the manifest on disk is always complete
+    """
+    with atomic_write(filename) as temp_filename, open(temp_filename,"w") as f:
+        json.dump(manifest, f, indent=1)
+
+def record_window(manifest,index,start_index,end_index,output):
+    """
+    Record in the manifest that window index has been written to output, with its content key and the output's
+    digest
+    """
+    manifest["windows"][str(index)] = {"start_index": int(start_index), "end_index": int(end_index),
+                                       "key": window_key(manifest["inputs"],start_index,end_index),
+                                       "output": output, "sha256": file_digest(output)}
+
+def is_finished(manifest,index,start_index,end_index,output,directory="."):
+    """
+    True if the manifest records window index as written to output for the current inputs, and output still has
+    the contents that were recorded. directory is the one that the manifest (and so output) is in
+    """
+    entry = manifest["windows"].get(str(index))
+    path = os.path.join(directory, output)
+    return (entry is not None and entry["output"] == output and os.path.exists(path)
+            and entry["key"] == window_key(manifest["inputs"],start_index,end_index)
+            and entry["sha256"] == file_digest(path))
@@ -0,0 +1,415 @@
+from itertools import combinations
+from typing import List, Any, Tuple, Optional, Collection
+import numpy as np
+import BKTree
+
+# (results, dist_best, exact_matches) of one lookup, with results and exact_matches as ids of unique vectors
+LookupResult = Tuple[List[int], int, List[int]]
+
+def distinct_rows(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    The distinct rows of a packed matrix, with the position of the first occurrence of each and the distinct row
+    of every row, as from np.unique(axis=0). Computed once per window and passed to choose_index() and
+    insert_all(), which both need it
+    """
+    unique, first, inverse = np.unique(vectors, axis=0, return_index=True, return_inverse=True)
+    return unique, first, inverse.reshape(-1)
+
+class NNIndex:
+    """
+    Interface of the nearest-neighbour indexes over packed haplotypes. Every distinct vector gets an id, in the
+    order the vectors were first inserted, and lookups return those ids (see BKTree.bk_tree_lookup() for the
+    meaning of the results)
+    """
+    kind = None
+
+    def insert(self, elements: List[Any], vector: BKTree.PackedVector):
+        """
+        Add a vector with its elements (integer sample IDs); a vector that is already present gets the
+        elements added to it
+        """
+        raise NotImplementedError
+
+    def insert_all(self, vectors: np.ndarray, elements: np.ndarray,
+                   distinct: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None):
+        """
+        Insert every row of a packed matrix, the ith row with the single element elements[i]. distinct is
+        distinct_rows(vectors), if it is already known
+        """
+        for vector, element in zip(vectors, elements.tolist()):
+            self.insert([element], vector)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        The (num_nodes x words) matrix of the distinct vectors, indexed by id
+        """
+        raise NotImplementedError
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.vectors)
+
+    def lookup(self, vector: BKTree.PackedVector, skip: Collection[Any],
+               stats: Optional[BKTree.LookupStats] = None) -> LookupResult:
+        """
+        The nearest neighbour(s) of vector whose elements are not all in skip, with all the ties
+        """
+        return self.lookup_batch(vector[None, :], [skip], stats)[0][0]
+
+    def lookup_batch(self, vectors: np.ndarray, skips: List[Collection[Any]],
+                     stats: Optional[BKTree.LookupStats] = None,
+                     bounds: Optional[np.ndarray] = None,
+                     max_distance: Optional[int] = None,
+                     max_visits: Optional[int] = None) -> Tuple[List[LookupResult], np.ndarray]:
+        """
+        lookup() for every row of a packed matrix, with skips[i] for the ith row. bounds are optional upper
+        bounds on the nearest distances, which only save work; max_distance is a cutoff beyond which no neighbours
+        are returned, and max_visits a budget of vectors examined per query, past which a query is given up with
+        the best neighbours found so far. Returns the lookups and the boolean array of the queries that were not
+        given up (see BKTree.bk_tree_lookup_batch())
+        """
+        raise NotImplementedError
+
+    def node_elements(self, node: int) -> List[Any]:
+        """
+        The elements of the vector with id node
+        """
+        raise NotImplementedError
+
+class BKTreeIndex(NNIndex):
+    """
+    NNIndex backed by a BK tree. Vectors are inserted into a pointer-based BK tree, which is flattened into a
+    BKTree.FlatBKTree for lookups. Ties are returned in the tree's traversal order
+    """
+    kind = "bktree"
+
+    def __init__(self, tree: Optional[BKTree.FlatBKTree] = None):
+        self.root_node = None
+        self.exact_index = None
+        self._tree = tree
+        self._flat_index = None
+
+    @staticmethod
+    def from_flat(tree: BKTree.FlatBKTree) -> "BKTreeIndex":
+        """
+        An index over an already built (e.g. memory-mapped) flat BK tree; it cannot be inserted into
+        """
+        return BKTreeIndex(tree)
+
+    def insert(self, elements, vector):
+        if self.root_node is None:
+            if self._tree is not None:
+                raise ValueError("cannot insert into a BK tree index loaded from a flat tree")
+            self.root_node = BKTree.BKTreeNode.make_empty()
+            self.exact_index = {}
+        BKTree.bk_tree_insert(self.root_node, elements, vector, BKTree.popcount_distance, self.exact_index)
+        self._tree = None
+
+    @property
+    def tree(self) -> BKTree.FlatBKTree:
+        if self._tree is None:
+            root_node = self.root_node if self.root_node is not None else BKTree.BKTreeNode.make_empty()
+            self._tree = BKTree.flatten_bk_tree(root_node)
+            self._flat_index = None
+        return self._tree
+
+    @property
+    def vectors(self):
+        return self.tree.vectors
+
+    @property
+    def depth(self) -> int:
+        return BKTree.flat_bk_tree_depth(self.tree)
+
+    def lookup_batch(self, vectors, skips, stats=None, bounds=None, max_distance=None, max_visits=None):
+        tree = self.tree
+        if self._flat_index is None:
+            self._flat_index = BKTree.flat_exact_index(tree)
+        return BKTree.flat_bk_tree_lookup_batch(tree, vectors, skips, self._flat_index, stats, bounds, max_distance,
+                                                max_visits)
+
+    def node_elements(self, node):
+        return self.tree.node_elements(node).tolist()
+
+class MultiIndexHashing(NNIndex):
+    """
+    Exact NNIndex by multi-index hashing. The window's alleles are split into blocks of block_bits, and every
+    block has a table from its alleles (as an integer key) to the ids of the vectors that have them. By the
+    pigeonhole principle, a vector within distance d of the query matches it within d // num_blocks mismatches
+    on at least one block, so probing every block with up to r flipped alleles finds all the vectors within
+    distance num_blocks*(r+1)-1. A query is resolved as soon as its best distance is within that radius, which
+    stays cheap when the nearest neighbours are many mismatches away (where a BK tree visits most of its nodes).
+    Queries that are still unresolved after max_radius are compared with all the remaining vectors, so lookups
+    are always exact. Ties are returned in id order.
+
+    Lookups are batched like BKTree.bk_tree_lookup_batch(): the probes and distances of chunk_size queries are
+    computed together. For LookupStats, nodes_visited counts the candidate vectors that were examined, and
+    pruned_subtrees the vectors that were never compared with the query.
+    """
+    kind = "mih"
+
+    def __init__(self, window_len: int, block_bits: int = 16, max_radius: int = 1, chunk_size: int = 256):
+        self.window_len = window_len
+        self.block_bits = block_bits
+        self.blocks = [(start, min(start + block_bits, window_len)) for start in range(0, window_len, block_bits)]
+        self.max_radius = max_radius
+        self.chunk_size = chunk_size
+        self.exact_index = {}
+        self.vector_list = []
+        self.elements = []
+        self.element_sets = []
+        self._vectors = None
+        self._tables = None
+
+    @property
+    def vectors(self):
+        if self._vectors is None:
+            words = (self.window_len + 63) // 64
+            self._vectors = (np.array(self.vector_list, dtype=np.uint64).reshape(-1, words) if self.vector_list
+                             else np.zeros((0, words), dtype=np.uint64))
+        return self._vectors
+
+    def _add_vectors(self, vectors, first_elements):
+        """
+        Append distinct vectors that are not in the index yet, each with its first element
+        """
+        for vector, element in zip(vectors, first_elements):
+            self.exact_index[BKTree.vector_key(vector)] = len(self.vector_list)
+            self.vector_list.append(vector)
+            self.elements.append([element])
+            self.element_sets.append({element})
+        self._vectors = None
+        self._tables = None
+
+    def insert(self, elements, vector):
+        node = self.exact_index.get(BKTree.vector_key(vector))
+        if node is None:
+            node = len(self.vector_list)
+            self._add_vectors([vector], elements[:1])
+            elements = elements[1:]
+        self.elements[node].extend(elements)
+        self.element_sets[node].update(elements)
+
+    def insert_all(self, vectors, elements, distinct=None):
+        if self.vector_list:
+            return super().insert_all(vectors, elements)
+        # Number the distinct vectors by first occurrence, as insert() would
+        _, first, inverse = distinct if distinct is not None else distinct_rows(vectors)
+        order = np.argsort(first, kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self._add_vectors(vectors[first[order]], elements[first[order]].tolist())
+        for row, node in enumerate(rank[inverse].tolist()):
+            if row != first[order[node]]:
+                self.elements[node].append(int(elements[row]))
+                self.element_sets[node].add(int(elements[row]))
+
+    def block_key(self, vectors, block):
+        """
+        The integer keys of one block of every row of a packed matrix: allele start+i of the block is bit i of
+        the key. They are shifted and masked out of the packed words, without unpacking the alleles
+        """
+        words = np.ascontiguousarray(vectors, dtype="<u8")
+        start, end = self.blocks[block]
+        word, offset = divmod(start, 64)
+        key = words[:, word] >> np.uint64(offset)
+        if offset + end - start > 64:
+            key |= words[:, word + 1] << np.uint64(64 - offset)
+        return (key & np.uint64((1 << (end - start)) - 1)).astype(np.int64)
+
+    def block_keys(self, vectors):
+        """
+        The (rows x num_blocks) integer keys of the blocks of every row of a packed matrix (see block_key()).
+        With 16-bit blocks these are just the packed words viewed as 16-bit integers, as the alleles past the end
+        of the window are 0
+        """
+        if self.block_bits == 16:
+            words = np.ascontiguousarray(vectors, dtype="<u8")
+            return words.view("<u2")[:, :len(self.blocks)].astype(np.int64)
+        return np.stack([self.block_key(vectors, block) for block in range(len(self.blocks))], axis=1)
+
+    def _build_tables(self):
+        """
+        For every block, its keys in sorted order and the ids of the vectors they belong to
+        """
+        keys = self.block_keys(self.vectors)
+        self._tables = []
+        for b in range(len(self.blocks)):
+            order = np.argsort(keys[:, b], kind="stable")
+            self._tables.append((keys[order, b], order))
+
+    def _probe(self, keys, radius):
+        """
+        The (row, id) pairs of the vectors that are within radius mismatches of row's block keys on some block
+        """
+        rows, ids = [], []
+        for b, (start, end) in enumerate(self.blocks):
+            sorted_keys, order = self._tables[b]
+            for flips in combinations(range(end - start), radius):
+                targets = keys[:, b] ^ sum(1 << f for f in flips)
+                lo = np.searchsorted(sorted_keys, targets, side="left")
+                counts = np.searchsorted(sorted_keys, targets, side="right") - lo
+                total = int(counts.sum())
+                if total == 0:
+                    continue
+                # The positions lo[r]...lo[r]+counts[r]-1 of every row r, concatenated
+                starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+                rows.append(np.repeat(np.arange(len(keys)), counts))
+                ids.append(order[starts + np.arange(total)])
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(rows), np.concatenate(ids)
+
+    def _has_only_skipped(self, node, skip):
+        if isinstance(skip, (set, frozenset)):
+            return self.element_sets[node] <= skip
+        return all(element in skip for element in self.element_sets[node])
+
+    def node_elements(self, node):
+        return self.elements[node]
+
+    def lookup_batch(self, vectors, skips, stats=None, bounds=None, max_distance=None, max_visits=None):
+        num_queries = len(vectors)
+        num_nodes = len(self.vector_list)
+        results = [[] for _ in range(num_queries)]
+        # bounds are not used: a bound is at least the nearest distance, so it is only within the radius of the
+        # probes when the nearest neighbours are too, and they are then found by the probes anyway. A cutoff
+        # does help: a query is resolved as soon as the probes cover max_distance
+        dist_best = np.full(num_queries, 2**32 if max_distance is None else max_distance, dtype=np.int64)
+        done = np.zeros(num_queries, dtype=bool)
+        complete = np.ones(num_queries, dtype=bool)
+        if num_nodes == 0:
+            return [([], 2**32, []) for q in range(num_queries)], complete
+        for q in range(num_queries):
+            node = self.exact_index.get(BKTree.vector_key(vectors[q]))
+            if node is not None and not self._has_only_skipped(node, skips[q]):
+                results[q] = [node]
+                dist_best[q] = 0
+                done[q] = True
+        if stats is not None:
+            stats.nodes_visited[done] += 1
+            stats.pruned_subtrees[done] += num_nodes - 1
+
+        if self._tables is None:
+            self._build_tables()
+        remaining = np.flatnonzero(~done)
+        for chunk_start in range(0, len(remaining), self.chunk_size):
+            given_up = self._lookup_chunk(remaining[chunk_start:chunk_start+self.chunk_size], vectors, skips,
+                                          results, dist_best, stats, max_visits)
+            complete[given_up] = False
+        for q in range(num_queries):
+            results[q].sort()
+        return [(results[q], int(dist_best[q]) if results[q] else 2**32, results[q] if dist_best[q] == 0 else [])
+                for q in range(num_queries)], complete
+
+    def _lookup_chunk(self, queries, vectors, skips, results, dist_best, stats, max_visits=None):
+        """
+        Look up the queries (indices into vectors) together, updating results and dist_best in place. With
+        max_visits smaller than the number of vectors, the queries that the probes leave unresolved are given up
+        instead of being compared with all the vectors, and returned. The (row, id) pairs that have been examined are kept as
+        the sorted array of row*num_nodes+id, so memory grows with the candidates rather than with the vectors
+        """
+        num_nodes = len(self.vector_list)
+        checked = np.zeros(0, dtype=np.int64)
+        scanned = []
+        given_up = queries[:0]
+        keys = self.block_keys(vectors[queries])
+        unresolved = np.arange(len(queries))
+        for radius in range(self.max_radius + 1):
+            rows, ids = self._probe(keys[unresolved], radius)
+            checked = self._examine(queries, unresolved[rows] * num_nodes + ids, checked, vectors, skips, results,
+                                    dist_best, stats)
+            unresolved = unresolved[dist_best[queries[unresolved]] > len(self.blocks) * (radius + 1) - 1]
+            if len(unresolved) == 0:
+                break
+        else:
+            if max_visits is not None and num_nodes > max_visits:
+                given_up = queries[unresolved]
+            else:
+                # Compare each query with all the vectors it was not compared with yet, one query at a time
+                for row in unresolved.tolist():
+                    lo, hi = np.searchsorted(checked, [row * num_nodes, (row + 1) * num_nodes])
+                    unchecked = np.ones(num_nodes, dtype=bool)
+                    unchecked[checked[lo:hi] - row * num_nodes] = False
+                    self._examine(queries, row * num_nodes + np.flatnonzero(unchecked), checked[:0], vectors, skips,
+                                  results, dist_best, stats)
+                    scanned.append(row)
+        if stats is not None:
+            examined = np.bincount(checked // num_nodes, minlength=len(queries))
+            examined[scanned] = num_nodes
+            stats.pruned_subtrees[queries] += num_nodes - examined
+        return given_up
+
+    def _examine(self, queries, pairs, checked, vectors, skips, results, dist_best, stats):
+        """
+        Compare the candidate (row, id) pairs, encoded as row*num_nodes+id, that are not in the sorted array
+        checked yet, in increasing distance per query, so only the candidates up to the best distance are
+        checked for skipping. Returns checked with the candidates added
+        """
+        # The same candidate can be found on several blocks
+        pairs = np.unique(pairs)
+        pairs = pairs[~np.isin(pairs, checked, assume_unique=True)]
+        checked = np.union1d(checked, pairs)
+        rows, ids = np.divmod(pairs, len(self.vector_list))
+        # popcount_distances() of each candidate with its own query
+        dists = BKTree.popcount_distances(self.vectors[ids], vectors[queries[rows]])
+        if stats is not None:
+            counts = np.bincount(rows, minlength=len(queries))
+            stats.nodes_visited[queries] += counts
+            stats.distance_evals[queries] += counts
+        order = np.lexsort((dists, rows))
+        rows, ids, dists = rows[order], ids[order], dists[order]
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]]) if len(rows) else np.zeros(0, dtype=np.int64)
+        ends = np.r_[starts[1:], len(rows)]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            q = int(queries[rows[start]])
+            for k in range(start, end):
+                dist = int(dists[k])
+                if dist > dist_best[q]:
+                    break
+                node = int(ids[k])
+                if self._has_only_skipped(node, skips[q]):
+                    continue
+                if dist < dist_best[q]:
+                    results[q] = [node]
+                    dist_best[q] = dist
+                else:
+                    results[q].append(node)
+        return checked
+
+INDEX_KINDS = {BKTreeIndex.kind: BKTreeIndex, MultiIndexHashing.kind: MultiIndexHashing}
+
+def choose_index(vectors, window_len, block_bits=16, max_radius=1, sample_size=64, max_shared=0.05, seed=0,
+                 unique=None):
+    """
+    Pick the index kind for a window of packed haplotypes. A BK tree prunes well when the haplotypes are
+    redundant, but visits most of its nodes once they are diverse. Multi-index hashing compares a query with
+    the haplotypes that share one of its blocks, so it is cheap when few do, provided that the nearest
+    neighbours are close enough for its probes to find them (within num_blocks*(max_radius+1)-1 mismatches,
+    which grows with the window width). For a random sample of the distinct haplotypes, this measures the
+    share of the distinct haplotypes that share a block with them and their distance to the nearest one, and
+    picks multi-index hashing if that share is at most max_shared and the median distance is in reach. unique
+    is the distinct rows of vectors, if they are already known (see distinct_rows())
+    """
+    if unique is None:
+        unique = np.unique(vectors, axis=0)
+    if len(unique) <= sample_size:
+        return BKTreeIndex.kind
+    mih = MultiIndexHashing(window_len, block_bits, max_radius)
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(unique), size=sample_size, replace=False)
+    # Only the sampled rows' keys are kept; the others are compared one block at a time
+    sample_keys = mih.block_keys(unique[sample])
+    shares_block = np.zeros((sample_size, len(unique)), dtype=bool)
+    for block in range(len(mih.blocks)):
+        shares_block |= mih.block_key(unique, block)[None, :] == sample_keys[:, block, None]
+    shared = shares_block.mean(axis=1)
+    nearest = []
+    for i in sample.tolist():
+        dists = BKTree.popcount_distances(unique, unique[i])
+        dists[i] = 2**32
+        nearest.append(dists.min())
+    if np.mean(shared) <= max_shared and np.median(nearest) < len(mih.blocks) * (max_radius + 1):
+        return MultiIndexHashing.kind
+    return BKTreeIndex.kind
@@ -0,0 +1,26 @@
+# Helpers shared by add_errors_igd.py and add_errors_vcf.py for adding noise to chunks of variants in parallel,
+# with output that does not depend on the number of workers
+
+from itertools import islice
+import numpy as np
+
+def chunk_rng(entropy, chunk):
+    """
+    The random number generator for the variants of chunk number `chunk`. Its stream is the child that
+    SeedSequence(entropy).spawn() gives that chunk, so every chunk has an independent stream that only depends
+    on the seed, not on which process handles the chunk or when.
+    """
+    return np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(chunk,)))
+
+def imap_bounded(pool, function, items, batch_size):
+    """
+    Yields function(item) for every item in order, like pool.imap(), but hands the pool only batch_size items at
+    a time, so that neither the items nor the results waiting to be written ever pile up in memory. Without a
+    pool (None), the items are processed in this process.
+    """
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            return
+        yield from (pool.imap(function, batch) if pool is not None else map(function, batch))
@@ -0,0 +1,117 @@
+import argparse
+import json
+import numpy as np
+import pandas as pd
+
+STAGES = ['parse_seconds', 'tree_build_seconds', 'lookup_seconds', 'collate_seconds']
+COUNTERS = ['nodes_visited', 'distance_evals', 'pruned_subtrees', 'warm_start_evals', 'dist_best']
+
+def read_profile(profile_file):
+    """
+    Returns the list of per-window records of a profile written by find_errors.py --profile
+    """
+    with open(profile_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def counter_summary(values):
+    """
+    Summary statistics of one per-lookup counter: its sum, mean, median, 90th and 99th percentiles and maximum
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if not len(values):
+        return {'sum': 0, 'mean': 0.0, 'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'max': 0}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {'sum': int(values.sum()), 'mean': float(values.mean()), 'p50': float(p50), 'p90': float(p90),
+            'p99': float(p99), 'max': int(values.max())}
+
+def window_summary(record):
+    """
+    Flatten a window's profile record into one row: its stage timings plus summaries of the per-lookup counters,
+    from the per-query counters or, for all-samples runs, the counter_summary() of each counter in the record.
+    prune_ratio is the share of the subtrees a query could have entered that it pruned, and total_distance_evals
+    counts the distances computed by the lookups and by their warm start
+    """
+    summaries = record.get('lookup_summary')
+    if summaries is None:
+        lookups = record.get('lookups', {})
+        summaries = {counter: counter_summary(lookups.get(counter, [])) for counter in COUNTERS}
+    row = {key: record.get(key) for key in ['window', 'start_index', 'end_index', 'haplotypes', 'queries', 'index',
+                                            'unique_vectors', 'tree_depth', 'incomplete_lookups', 'total_seconds',
+                                            'peak_rss_mb', 'window_rss_mb'] + STAGES}
+    for counter in COUNTERS:
+        row[f'mean_{counter}'] = summaries[counter]['mean']
+        row[f'max_{counter}'] = summaries[counter]['max']
+    row['p99_distance_evals'] = summaries['distance_evals']['p99']
+    pruned = summaries['pruned_subtrees']['sum']
+    visited = summaries['nodes_visited']['sum']
+    row['prune_ratio'] = float(pruned / (pruned + visited)) if pruned + visited else 1.0
+    row['total_distance_evals'] = summaries['distance_evals']['sum'] + summaries['warm_start_evals']['sum']
+    return row
+
+def summarize(records):
+    """
+    Returns the DataFrame of window_summary() rows of all the windows, ordered by window
+    """
+    return pd.DataFrame([window_summary(r) for r in records]).sort_values('window').reset_index(drop=True)
+
+def pathological_windows(summary, factor=3.0):
+    """
+    Returns the windows whose total time, mean distance evaluations per query or RSS growth are more than factor
+    times the median over all windows, with a 'reasons' column naming the metrics that are out of line, slowest
+    first. Profiles without per-window RSS (older ones, or from systems where it cannot be measured) are only
+    checked for time and distance evaluations
+    """
+    metrics = ['total_seconds', 'mean_distance_evals', 'window_rss_mb']
+    values = summary[metrics].astype(float)
+    medians = values.median()
+    reasons = [[metric for metric in metrics if medians[metric] > 0 and row[metric] > factor * medians[metric]]
+               for _, row in values.iterrows()]
+    flagged = summary.assign(reasons=[', '.join(r) for r in reasons])[[len(r) > 0 for r in reasons]]
+    return flagged.sort_values('total_seconds', ascending=False)
+
+def compare_distance_evals(summary, baseline):
+    """
+    Returns the distance evaluations of every window (summed over its parts) in summary and in the summary of a
+    baseline run over the same windows, e.g. the same run without --warm_start, and how many were saved
+    """
+    evals = summary.groupby('window')['total_distance_evals'].sum()
+    baseline_evals = baseline.groupby('window')['total_distance_evals'].sum()
+    comparison = pd.DataFrame({'baseline_evals': baseline_evals, 'evals': evals}).dropna().astype(np.int64)
+    comparison['saved'] = comparison['baseline_evals'] - comparison['evals']
+    comparison['saved_fraction'] = comparison['saved'] / comparison['baseline_evals'].clip(lower=1)
+    return comparison.reset_index()
+
+def main():
+    parser = argparse.ArgumentParser(description="summarize a find_errors.py --profile file and find pathological windows")
+    parser.add_argument('profile', help="JSON-lines profile file written by find_errors.py --profile")
+    parser.add_argument('-f', '--factor', type=float, default=3.0, help="flag windows more than this many times the median")
+    parser.add_argument('-n', '--top', type=int, default=10, help="number of slowest windows to list")
+    parser.add_argument('-o', '--output', default=None, help="CSV file for the per-window summary")
+    parser.add_argument('-b', '--baseline', default=None, help="profile of a baseline run over the same windows (e.g. without --warm_start) to report the distance evaluations saved against")
+    args = parser.parse_args()
+
+    summary = summarize(read_profile(args.profile))
+    if args.output is not None:
+        summary.to_csv(args.output, index=False)
+
+    columns = ['window', 'total_seconds'] + STAGES + ['peak_rss_mb', 'window_rss_mb', 'index', 'unique_vectors',
+                                                       'tree_depth', 'mean_distance_evals', 'prune_ratio']
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(f"{len(summary)} windows, {summary['total_seconds'].sum():.1f} seconds in total")
+        print("time per stage:")
+        print(summary[STAGES].sum().to_string())
+        print(f"\nslowest {args.top} windows:")
+        print(summary.nlargest(args.top, 'total_seconds')[columns].to_string(index=False))
+        flagged = pathological_windows(summary, args.factor)
+        print(f"\n{len(flagged)} pathological windows (more than {args.factor}x the median):")
+        if len(flagged):
+            print(flagged[columns + ['reasons']].to_string(index=False))
+        if args.baseline is not None:
+            comparison = compare_distance_evals(summary, summarize(read_profile(args.baseline)))
+            baseline_total, saved = comparison['baseline_evals'].sum(), comparison['saved'].sum()
+            print(f"\ndistance evaluations: {comparison['evals'].sum()} against {baseline_total} in the baseline, "
+                  f"{saved} saved ({saved / max(baseline_total, 1):.1%}) over {len(comparison)} windows")
+            print(comparison.describe().loc[['mean', 'min', '50%', 'max'], ['saved', 'saved_fraction']].to_string())
+
+if __name__ == "__main__":
+    main()
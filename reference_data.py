@@ -0,0 +1,106 @@
+from dataclasses import dataclass
+from typing import List, Dict, Set
+import argparse
+import pickle
+import numpy as np
+
+@dataclass
+class ReferenceData:
+    # All sample names of individuals in the igd, in igd order (ukbiobank_header.txt)
+    samp_names: List[str]
+    # Map from sample name to its integer sample ID, its position in samp_names
+    sample_ids: Dict[str, int]
+    # The relatives of sample ID i are relative_ids[relative_offsets[i]:relative_offsets[i+1]]
+    relative_offsets: np.ndarray
+    relative_ids: np.ndarray
+    # The individual indices of all the trio samples in the igd
+    trio_set: Set[int]
+    # Map from trio sample names to the associated child sample name(s)
+    child_finder: Dict[str, List[str]]
+
+    def relatives(self, sample_id: int) -> Set[int]:
+        """
+        The set of sample IDs to skip when querying sample_id (its close relatives, including itself)
+        """
+        start, end = self.relative_offsets[sample_id], self.relative_offsets[sample_id+1]
+        return set(self.relative_ids[start:end].tolist())
+
+def read_samples(samples):
+    """
+    Returns the sample names from the samples header file
+    """
+    with open(samples,"r") as s:
+        return s.readline().split()
+
+def relatives_csr(skipping_dict,samp_names):
+    """
+    Convert a dictionary {sample name: close relative sample names} into CSR arrays (offsets, ids) over integer
+    sample IDs. Samples that are missing from the dictionary get only themselves as a relative
+    """
+    sample_ids = {name: i for i, name in enumerate(samp_names)}
+    offsets = np.zeros(len(samp_names)+1, dtype=np.int64)
+    ids = []
+    for i, name in enumerate(samp_names):
+        relatives = skipping_dict.get(name, [name])
+        ids.extend(sorted({sample_ids[r] for r in relatives if r in sample_ids}))
+        offsets[i+1] = len(ids)
+    return offsets, np.array(ids, dtype=np.int64)
+
+def load_reference(samples,relatives,trios,child_find):
+    """
+    Load all the reference data used for matching. The relatives can either be the pickled dictionary or its
+    compact CSR version written by write_relatives()
+    """
+    samp_names = read_samples(samples)
+    if relatives.endswith(".npz"):
+        with np.load(relatives) as r:
+            relative_offsets, relative_ids = r["offsets"], r["ids"]
+        if len(relative_offsets) != len(samp_names)+1:
+            raise ValueError(f"{relatives} was written for a different samples file than {samples}")
+    else:
+        with open(relatives,"rb") as r:
+            relative_offsets, relative_ids = relatives_csr(pickle.load(r), samp_names)
+    with open(trios,"rb") as t:
+        trio_set = pickle.load(t)
+    with open(child_find,"rb") as c:
+        child_finder = pickle.load(c)
+    return ReferenceData(samp_names=samp_names,
+                         sample_ids={name: i for i, name in enumerate(samp_names)},
+                         relative_offsets=relative_offsets,
+                         relative_ids=relative_ids,
+                         trio_set=trio_set,
+                         child_finder=child_finder)
+
+# Reference data already loaded by this process, keyed by the input files
+_loaded = {}
+
+def get_reference(samples,relatives,trios,child_find):
+    """
+    Returns the reference data for the given files, loading it only the first time it is requested in this
+    process. Loading it in the parent before creating a fork()ed pool shares it with all the workers
+    """
+    key = (samples,relatives,trios,child_find)
+    if key not in _loaded:
+        _loaded[key] = load_reference(samples,relatives,trios,child_find)
+    return _loaded[key]
+
+def write_relatives(samples,relatives,outfile):
+    """
+    Convert the pickled relatives dictionary into the compact CSR format (a .npz file)
+    """
+    samp_names = read_samples(samples)
+    with open(relatives,"rb") as r:
+        offsets, ids = relatives_csr(pickle.load(r), samp_names)
+    np.savez(outfile, offsets=offsets, ids=ids)
+
+def main():
+    parser = argparse.ArgumentParser(description="convert the pickled relatives dictionary into a compact CSR file of integer sample IDs")
+    parser.add_argument('-s','--samples',required=True,help="txt file with a list of all sample names in the igd file")
+    parser.add_argument('-r','--relatives',required=True,help="pickle file of dictionary with keys as samples, values as the close relatives to skip when querying the key")
+    parser.add_argument('-o','--outfile',required=True,help="output .npz file")
+    args = parser.parse_args()
+
+    write_relatives(args.samples,args.relatives,args.outfile)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from pyigd import IGDWriter
+
+import add_errors_igd
+from edits import EditsWriter
+
+NUM_INDIVIDUALS = 40
+NUM_VARIANTS = 230
+
+@pytest.fixture
+def igd_file(tmp_path):
+    """
+    A small IGD file of random phased haplotypes, with a few rows of missing data
+    """
+    rng = np.random.default_rng(0)
+    filename = str(tmp_path / "input.igd")
+    with open(filename, "wb") as f:
+        writer = IGDWriter(f, NUM_INDIVIDUALS)
+        writer.write_header()
+        for i in range(NUM_VARIANTS):
+            samples = np.flatnonzero(rng.random(2 * NUM_INDIVIDUALS) < 0.3).tolist()
+            writer.write_variant(1000 + 10 * i, "A", "G", samples, is_missing=(i % 50 == 7))
+        writer.write_index()
+        writer.write_variant_info()
+        writer.write_individual_ids([])
+        writer.write_variant_ids([])
+        f.seek(0)
+        writer.write_header()
+    return filename
+
+def add_noise(igd_file, directory, workers, method):
+    """
+    Add noise with a fixed seed and chunk size with add_noise_parallel(), or with AddNoiseToBV as the CLI does
+    for a single worker (workers=None); returns the bytes of the noisy IGD file and of the edits file
+    """
+    outfile, edits_file = str(directory / f"noisy_{workers}.igd"), str(directory / f"edits_{workers}.bin")
+    entropy = np.random.SeedSequence(5).entropy
+    with EditsWriter(edits_file) as edits:
+        if workers is not None:
+            add_errors_igd.add_noise_parallel(igd_file, outfile, edits, 0.01, 0.05, entropy, method, chunk_size=17,
+                                              workers=workers)
+        else:
+            with open(igd_file, "rb") as fin, open(outfile, "wb") as fout:
+                add_errors_igd.AddNoiseToBV(fin, fout, edits, 0.01, 0.05, entropy, method, chunk_size=17).transform()
+    with open(outfile, "rb") as f, open(edits_file, "rb") as g:
+        return f.read(), g.read()
+
+@pytest.mark.parametrize("method", sorted(add_errors_igd.FLIP_METHODS))
+def test_output_does_not_depend_on_workers(igd_file, tmp_path, method):
+    one_worker = add_noise(igd_file, tmp_path, 1, method)
+    assert add_noise(igd_file, tmp_path, 3, method) == one_worker
+    assert add_noise(igd_file, tmp_path, None, method) == one_worker
+    with open(igd_file, "rb") as f:
+        assert one_worker[0] != f.read()
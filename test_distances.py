@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+import BKTree
+import find_errors
+import nn_index
+
+LENGTHS = [1, 7, 63, 64, 65, 127, 128, 200]
+
+def random_vectors(rng, count, length, flip=0.1):
+    """
+    Random 0/1 vectors as lists, mostly close to a few founders so that there are ties and exact matches
+    """
+    founders = rng.integers(0, 2, size=(4, length))
+    vectors = founders[rng.integers(0, len(founders), size=count)] ^ (rng.random((count, length)) < flip)
+    return vectors.astype(int).tolist()
+
+@pytest.mark.parametrize("length", LENGTHS)
+def test_popcount_distance_matches_hamming_distance(length):
+    rng = np.random.default_rng(length)
+    vectors = random_vectors(rng, 40, length, flip=0.5)
+    for vector1 in vectors:
+        for vector2 in vectors[:10]:
+            assert (BKTree.popcount_distance(BKTree.pack_vector(vector1), BKTree.pack_vector(vector2))
+                    == find_errors.hamming_distance(vector1, vector2))
+
+@pytest.mark.parametrize("length", LENGTHS)
+def test_pack_vector_round_trip(length):
+    rng = np.random.default_rng(length)
+    for vector in random_vectors(rng, 10, length, flip=0.5):
+        packed = BKTree.pack_vector(vector)
+        assert len(packed) == (length + 63) // 64
+        assert BKTree.unpack_vector(packed, length) == vector
+
+def build(vectors, distance):
+    root_node = BKTree.BKTreeNode.make_empty()
+    index = {}
+    for i, vector in enumerate(vectors):
+        BKTree.bk_tree_insert(root_node, [i//2], vector, distance, index)
+    return root_node, index
+
+def neighbours(result):
+    results, dist_best, exact_matches = result
+    return sorted(tuple(sorted(node.element_set)) for node in results), dist_best, len(exact_matches)
+
+@pytest.mark.parametrize("length", LENGTHS)
+def test_bk_tree_lookup_list_and_packed_agree(length):
+    rng = np.random.default_rng(1000 + length)
+    vectors = random_vectors(rng, 60, length)
+    queries = random_vectors(rng, 20, length) + vectors[:10]
+    list_tree, list_index = build(vectors, find_errors.hamming_distance)
+    packed_tree, packed_index = build([BKTree.pack_vector(v) for v in vectors], BKTree.popcount_distance)
+    for query in queries:
+        skip = set(rng.choice(30, size=3, replace=False).tolist())
+        expected = neighbours(BKTree.bk_tree_lookup(list_tree, query, find_errors.hamming_distance, skip, list_index))
+        found = neighbours(BKTree.bk_tree_lookup(packed_tree, BKTree.pack_vector(query), BKTree.popcount_distance,
+                                                 skip, packed_index))
+        assert found == expected
+        # The nearest neighbours really are the nearest among the vectors that are not skipped
+        distances = [find_errors.hamming_distance(query, v) for i, v in enumerate(vectors) if i//2 not in skip]
+        assert expected[1] == min(distances)
+
+@pytest.mark.parametrize("block_bits", [16, 10, 33])
+@pytest.mark.parametrize("length", LENGTHS)
+def test_block_keys_match_unpacked_alleles(length, block_bits):
+    rng = np.random.default_rng(length)
+    bits = np.array(random_vectors(rng, 20, length, flip=0.5))
+    mih = nn_index.MultiIndexHashing(length, block_bits)
+    expected = np.stack([bits[:, start:end] @ (1 << np.arange(end - start)) for start, end in mih.blocks], axis=1)
+    assert (mih.block_keys(BKTree.pack_matrix(bits)) == expected).all()
+
+@pytest.mark.parametrize("flip", [0.02, 0.5])
+@pytest.mark.parametrize("length", [20, 64, 150])
+def test_mih_lookup_matches_bk_tree(length, flip):
+    rng = np.random.default_rng(2000 + length)
+    vectors = BKTree.pack_matrix(random_vectors(rng, 300, length, flip))
+    queries = np.concatenate([BKTree.pack_matrix(random_vectors(rng, 40, length, flip)), vectors[:20]])
+    skips = [set(rng.choice(150, size=3, replace=False).tolist()) for _ in range(len(queries))]
+    elements = np.arange(len(vectors)) // 2
+    bk_tree = nn_index.BKTreeIndex()
+    bk_tree.insert_all(vectors, elements)
+    mih = nn_index.MultiIndexHashing(length)
+    mih.insert_all(vectors, elements)
+    stats = BKTree.LookupStats.zeros(len(queries))
+    for (bk_results, bk_dist, _), (results, dist, _) in zip(bk_tree.lookup_batch(queries, skips)[0],
+                                                             mih.lookup_batch(queries, skips, stats)[0]):
+        assert dist == bk_dist
+        # The indexes number the distinct vectors differently, so compare what the neighbours hold
+        assert (sorted(tuple(sorted(mih.node_elements(node))) for node in results)
+                == sorted(tuple(sorted(bk_tree.node_elements(node))) for node in bk_results))
+    assert (stats.nodes_visited + stats.pruned_subtrees == mih.num_nodes).all()